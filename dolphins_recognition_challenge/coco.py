@@ -1,10 +1,17 @@
 import os
 import cv2
+import json
+import hashlib
+from collections.abc import Sequence
+from pycocotools import mask as mask_utils
 from torchvision.datasets import CocoDetection
-from copy_paste import copy_paste_class
+from dolphins_recognition_challenge.copy_paste import copy_paste_class
 
 min_keypoints_per_image = 10
 
+#ids of images with valid annotations, stored next to the annotation file
+valid_ids_suffix = '.valid_ids.json'
+
 def _count_visible_keypoints(anno):
     return sum(sum(1 for v in ann["keypoints"][2::3] if v > 0) for ann in anno)
 
@@ -29,28 +36,90 @@ def has_valid_annotation(anno):
 
     return False
 
+def _file_sha1(fname):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def load_or_build_valid_ids(coco, ann_file, img_ids):
+    """ Returns ids from `img_ids` of images with valid annotations. They are computed once per contents of
+    the annotation file and stored next to it.
+    """
+    index_path = ann_file + valid_ids_suffix
+    sha1 = _file_sha1(ann_file)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index['sha1'] == sha1 and index['img_ids'] == list(img_ids):
+            return index['ids']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    ids = [img_id for img_id in img_ids if has_valid_annotation(coco.imgToAnns[img_id])]
+
+    #the index is only an optimization, so a read-only directory is fine
+    try:
+        tmp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'sha1': sha1, 'img_ids': list(img_ids), 'ids': ids}, f)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        pass
+
+    return ids
+
+class RLEMasks(Sequence):
+    """ Instance masks kept as COCO run-length encodings. A mask is decoded only when it is accessed, so
+    objects that no transform touches are never decoded.
+    """
+    def __init__(self, rles):
+        self.rles = rles
+        #albumentations checks shapes by accessing the first mask repeatedly,
+        #so the last decoded mask is kept
+        self._last = (None, None)
+
+    def __len__(self):
+        return len(self.rles)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RLEMasks(self.rles[index])
+        index = range(len(self.rles))[index]
+        if self._last[0] != index:
+            mask = mask_utils.decode(self.rles[index])
+            #the kept mask is shared by all accesses, so it must not be modified
+            mask.setflags(write=False)
+            self._last = (index, mask)
+        return self._last[1]
+
+    @property
+    def nbytes(self):
+        return sum(len(rle['counts']) for rle in self.rles)
+
 @copy_paste_class
 class CocoDetectionCP(CocoDetection):
     def __init__(
         self,
         root,
         annFile,
-        transforms
+        transforms,
+        example_cache_bytes=512 * 2 ** 20,
+        partner_reuse=0.5
     ):
         super(CocoDetectionCP, self).__init__(
             root, annFile, None, None, transforms
         )
+        #recently loaded examples are kept in every worker, up to `example_cache_bytes`,
+        #and copy-paste partners are drawn from them with probability `partner_reuse`
+        self.example_cache_bytes = example_cache_bytes
+        self.partner_reuse = partner_reuse
 
         # filter images without detection annotations
-        ids = []
-        for img_id in self.ids:
-            ann_ids = self.coco.getAnnIds(imgIds=img_id, iscrowd=None)
-            anno = self.coco.loadAnns(ann_ids)
-            if has_valid_annotation(anno):
-                ids.append(img_id)
-        self.ids = ids
+        self.ids = load_or_build_valid_ids(self.coco, annFile, self.ids)
 
-    def load_example(self, index):
+    def load_raw_example(self, index):
         img_id = self.ids[index]
         ann_ids = self.coco.getAnnIds(imgIds=img_id)
         target = self.coco.loadAnns(ann_ids)
@@ -59,19 +128,19 @@ class CocoDetectionCP(CocoDetection):
         image = cv2.imread(os.path.join(self.root, path))
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-        #convert all of the target segmentations to masks
+        #target segmentations are converted to RLE masks, decoded only when needed
         #bboxes are expected to be (y1, x1, y2, x2, category_id)
-        masks = []
+        masks = RLEMasks([self.coco.annToRLE(obj) for obj in target])
         bboxes = []
         for ix, obj in enumerate(target):
-            masks.append(self.coco.annToMask(obj))
             bboxes.append(obj['bbox'] + [obj['category_id']] + [ix])
 
         #pack outputs into a dict
-        output = {
+        return {
             'image': image,
             'masks': masks,
             'bboxes': bboxes
         }
-        
-        return self.transforms(**output)
+
+    def load_example(self, index):
+        return self.transforms(**self.load_raw_example(index))
@@ -0,0 +1,160 @@
+"""Converter of the dataset into COCO annotations with RLE masks, loaded without decoding and quantizing PNGs."""
+
+__all__ = ['convert_to_coco', 'convert_dataset_to_coco']
+
+from pathlib import Path
+from typing import *
+
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+from fastcore.script import *
+from pycocotools import mask as mask_utils
+
+from dolphins_recognition_challenge.datasets import (
+    _enumerate_image_for_classes,
+    _enumerate_image_for_instances,
+    _extract_instances,
+    _load_or_build_manifest,
+    _load_or_enumerate_class_colors,
+    _map_files,
+    _open_image,
+)
+from dolphins_recognition_challenge.zip_reader import ZipRoot
+
+# class colors and signatures of the files of every image, stored in the COCO file for incremental conversion
+_sources_key = "dolphins_sources"
+
+
+def _annotate_sample(item) -> List[Dict[str, Any]]:
+    """Converts instances of a sample into COCO annotations (without ids) with RLE segmentations"""
+    label_path, mask_path, class_colors = item
+    with _open_image(mask_path) as mask_img, _open_image(label_path) as label_img:
+        mask = _enumerate_image_for_instances(mask_img)
+        label_array = _enumerate_image_for_classes(label_img, class_colors)
+    obj_ids, boxes, areas, labels = _extract_instances(mask, label_array)
+
+    annotations = []
+    for obj_id, (xmin, ymin, xmax, ymax), area, label in zip(obj_ids, boxes.tolist(), areas.tolist(), labels.tolist()):
+        # degenerated boxes are skipped, like in `DolphinsInstanceSegmentationDataset`
+        if xmax <= xmin or ymax <= ymin:
+            continue
+        rle = mask_utils.encode(np.asfortranarray((mask == obj_id).view(np.uint8)))
+        annotations.append(dict(
+            category_id=int(label),
+            segmentation=dict(size=rle["size"], counts=rle["counts"].decode("ascii")),
+            area=int(area),
+            bbox=[xmin, ymin, xmax - xmin + 1, ymax - ymin + 1],
+            iscrowd=0,
+        ))
+    return annotations
+
+
+def _load_previous(out_path: Path) -> Tuple[Optional[List[List[int]]], Dict[str, Dict[str, Any]]]:
+    """Reads class colors and signatures and annotations of every sample converted by the previous run"""
+    try:
+        coco = json.loads(out_path.read_text())
+        sources = coco[_sources_key]
+        annotations = defaultdict(list)
+        for annotation in coco["annotations"]:
+            annotations[annotation["image_id"]].append(
+                {k: v for k, v in annotation.items() if k not in ("id", "image_id")}
+            )
+        samples = {
+            stem: {"signature": sample["signature"], "annotations": annotations[sample["image_id"]]}
+            for stem, sample in sources["samples"].items()
+        }
+        return sources["class_colors"], samples
+    except (OSError, ValueError, KeyError):
+        return None, {}
+
+
+def convert_to_coco(
+    root: Union[Path, ZipRoot],
+    out_path: Path,
+    *,
+    n_samples: int = -1,
+    max_workers: Optional[int] = None,
+) -> Tuple[int, int]:
+    """Writes annotations of a dataset directory (`JPEGImages`, `SegmentationClass`, `SegmentationObject`) into
+    a COCO file with RLE segmentations, for `CocoDetectionCP` with images in `root / "JPEGImages"`.
+
+    Conversion is incremental: samples whose label and mask files have the same mtimes and sizes as in the
+    previous run are not converted again. Returns the number of images and the number of converted images.
+    """
+    out_path = Path(out_path)
+
+    manifest = _load_or_build_manifest(root)
+    # negative `n_samples` selects all samples
+    selected = slice(n_samples if n_samples >= 0 else None)
+    stems = [str(stem) for stem in manifest["stems"][selected]]
+    label_paths = [root / "SegmentationClass" / str(name) for name in manifest["label_names"][selected]]
+    mask_paths = [root / "SegmentationObject" / str(name) for name in manifest["mask_names"][selected]]
+    # files are checked on their own, the manifest only notices added and removed files
+    signatures = [
+        [x for st in (label_path.stat(), mask_path.stat()) for x in (st.st_mtime_ns, st.st_size)]
+        for label_path, mask_path in zip(label_paths, mask_paths)
+    ]
+
+    class_colors = _load_or_enumerate_class_colors(root, label_paths)
+    colors = [list(color) for color in class_colors]
+
+    # everything is converted again if classes changed
+    previous_colors, previous = _load_previous(out_path)
+    if previous_colors != colors:
+        previous = {}
+    changed = [
+        i for i, (stem, signature) in enumerate(zip(stems, signatures))
+        if stem not in previous or previous[stem]["signature"] != signature
+    ]
+    converted = _map_files(
+        _annotate_sample, [(label_paths[i], mask_paths[i], class_colors) for i in changed], max_workers
+    )
+    samples = {stem: previous.get(stem) for stem in stems}
+    for i, annotations in zip(changed, converted):
+        samples[stems[i]] = {"signature": signatures[i], "annotations": annotations}
+
+    images, annotations, sources = [], [], {}
+    for image_id, (stem, img_name, (height, width)) in enumerate(
+        zip(stems, manifest["img_names"][selected], manifest["shapes"][selected].tolist())
+    ):
+        images.append(dict(id=image_id, file_name=str(img_name), height=height, width=width))
+        for annotation in samples[stem]["annotations"]:
+            annotations.append(dict(annotation, id=len(annotations) + 1, image_id=image_id))
+        sources[stem] = {"signature": samples[stem]["signature"], "image_id": image_id}
+
+    # background is not a category
+    categories = [
+        dict(id=i, name="color_{:02x}{:02x}{:02x}".format(*color)) for i, color in enumerate(colors) if i > 0
+    ]
+    coco = dict(
+        images=images,
+        annotations=annotations,
+        categories=categories,
+        **{_sources_key: {"class_colors": colors, "samples": sources}},
+    )
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(f"{out_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(coco))
+    os.replace(tmp_path, out_path)
+
+    return len(images), len(changed)
+
+
+@call_parse
+def convert_dataset_to_coco(
+    src_path: Param("input directory containing Train and Val directories", Path),
+    dst_path: Param("output directory for COCO annotation files", Path),
+    splits: Param("comma separated directories to convert", str) = "Train,Val",
+    n_samples: Param("number of samples of every split to convert, all by default", int) = -1,
+    max_workers: Param("number of processes converting samples, number of CPUs by default", int) = None,
+):
+    """Converts annotations of the dataset splits into COCO files with RLE masks, `<split>.json` for every split"""
+    for split in splits.split(","):
+        n_images, n_converted = convert_to_coco(
+            Path(src_path) / split, Path(dst_path) / f"{split}.json", n_samples=n_samples, max_workers=max_workers
+        )
+        print(f"{split}: converted {n_converted} of {n_images} images into: {(Path(dst_path) / f'{split}.json').resolve()}")
@@ -3,76 +3,102 @@ import cv2
 import random
 import numpy as np
 import albumentations as A
+from collections import OrderedDict
 from copy import deepcopy
-from skimage.filters import gaussian
+
+def _alpha_roi(alpha, margin=0):
+    #slices of the bounding box of nonzero alpha grown by margin, None if alpha is empty
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if rows.shape[0] == 0:
+        return None
+    cols = np.flatnonzero(alpha.any(axis=0))
+    h, w = alpha.shape
+    return (
+        slice(max(rows[0] - margin, 0), min(rows[-1] + 1 + margin, h)),
+        slice(max(cols[0] - margin, 0), min(cols[-1] + 1 + margin, w)),
+    )
 
 def image_copy_paste(img, paste_img, alpha, blend=True, sigma=1):
     if alpha is not None:
+        #feathered alpha is nonzero within the gaussian kernel radius
+        #(truncated at 4 sigma) around the objects, pixels outside are not touched
+        radius = int(4 * sigma + 0.5) if blend and sigma > 0 else 0
+        roi = _alpha_roi(alpha, radius)
+        if roi is None:
+            return img
+
+        img_roi = img[roi]
+        paste_roi = paste_img[roi]
+        img = img.copy()
         if blend:
-            alpha = gaussian(alpha, sigma=sigma, preserve_range=True)
-
-        img_dtype = img.dtype
-        alpha = alpha[..., None]
-        img = paste_img * alpha + img * (1 - alpha)
-        img = img.astype(img_dtype)
+            alpha_roi = alpha[roi].astype(np.float32)
+            if radius > 0:
+                #the roi is either surrounded by zeros of alpha or ends at the image border,
+                #so replicating its border is the same as blurring the whole alpha
+                alpha_roi = cv2.GaussianBlur(
+                    alpha_roi, (2 * radius + 1, 2 * radius + 1), sigma, borderType=cv2.BORDER_REPLICATE
+                )
+            blended = img_roi.astype(np.float32)
+            blended += alpha_roi[..., None] * (paste_roi.astype(np.float32) - blended)
+            img[roi] = blended.astype(img.dtype)
+        else:
+            np.copyto(img[roi], paste_roi, casting="unsafe", where=alpha[roi][..., None] != 0)
 
     return img
 
 def mask_copy_paste(mask, paste_mask, alpha):
     raise NotImplementedError
 
-def masks_copy_paste(masks, paste_masks, alpha):
+def occlude_masks(masks, alpha):
+    #binary N x H x W masks without the pixels that will be pasted over,
+    #computed for all masks at once into a single output array
+    occluded = np.empty((len(masks),) + alpha.shape, dtype=bool)
+    np.not_equal(np.asarray(masks), 0, out=occluded)
+    occluded &= ~alpha
+    return occluded.view(np.uint8)
+
+def masks_copy_paste(masks, paste_masks, alpha, occluded_masks=None):
     if alpha is not None:
         #eliminate pixels that will be pasted over
-        masks = [
-            np.logical_and(mask, np.logical_xor(mask, alpha)).astype(np.uint8) for mask in masks
-        ]
-        masks.extend(paste_masks)
+        if occluded_masks is None:
+            occluded_masks = occlude_masks(masks, alpha)
+        if len(paste_masks) == 0:
+            return occluded_masks
+        masks = np.concatenate([occluded_masks, np.asarray(paste_masks).astype(np.uint8, copy=False)])
 
     return masks
 
 def extract_bboxes(masks):
-    bboxes = []
-    h, w = masks[0].shape
-    for mask in masks:
-        yindices = np.where(np.any(mask, axis=0))[0]
-        xindices = np.where(np.any(mask, axis=1))[0]
-        if yindices.shape[0]:
-            y1, y2 = yindices[[0, -1]]
-            x1, x2 = xindices[[0, -1]]
-            y2 += 1
-            x2 += 1
-            y1 /= w
-            y2 /= w
-            x1 /= h
-            x2 /= h
-        else:
-            y1, x1, y2, x2 = 0, 0, 0, 0
-
-        bboxes.append((y1, x1, y2, x2))
-
-    return bboxes
-
-def bboxes_copy_paste(bboxes, paste_bboxes, masks, paste_masks, alpha, key):
+    #normalized (x_min, y_min, x_max, y_max) of N x H x W masks, (0, 0, 0, 0) for empty ones
+    masks = np.asarray(masks)
+    n, h, w = masks.shape
+    cols = masks.any(axis=1)
+    rows = masks.any(axis=2)
+    bboxes = np.column_stack([
+        cols.argmax(axis=1) / w,
+        rows.argmax(axis=1) / h,
+        (w - cols[:, ::-1].argmax(axis=1)) / w,
+        (h - rows[:, ::-1].argmax(axis=1)) / h,
+    ])
+    bboxes[~cols.any(axis=1)] = 0
+
+    return [tuple(bbox) for bbox in bboxes.tolist()]
+
+def bboxes_copy_paste(bboxes, paste_bboxes, masks, paste_masks, alpha, key, occluded_masks=None):
     if key == 'paste_bboxes':
         return bboxes
     elif paste_bboxes is not None:
-        masks = masks_copy_paste(masks, paste_masks=[], alpha=alpha)
-        adjusted_bboxes = extract_bboxes(masks)
+        if occluded_masks is None:
+            occluded_masks = occlude_masks(masks, alpha)
 
         #only keep the bounding boxes for objects listed in bboxes
-        mask_indices = [box[-1] for box in bboxes]
-        adjusted_bboxes = [adjusted_bboxes[int(idx)] for idx in mask_indices]
+        mask_indices = np.array([int(box[-1]) for box in bboxes], dtype=np.int64)
+        adjusted_bboxes = extract_bboxes(occluded_masks[mask_indices])
         #append bbox tails (classes, etc.)
-        #print("adjusted_bboxes ", adjusted_bboxes)
-        #print("bboxes ", bboxes)
         adjusted_bboxes = [bbox + tail[4:] for bbox, tail in zip(adjusted_bboxes, bboxes)]
 
         #adjust paste_bboxes mask indices to avoid overlap
-        if len(masks) > 0:
-            max_mask_index = len(masks)
-        else:
-            max_mask_index = 0
+        max_mask_index = len(occluded_masks)
 
         paste_mask_indices = [max_mask_index + ix for ix in range(len(paste_bboxes))]
         paste_bboxes = [pbox[:-1] + [pmi] for pbox, pmi in zip(paste_bboxes, paste_mask_indices)]
@@ -166,6 +192,7 @@ class CopyPaste(A.DualTransform):
                 "paste_masks": None,
                 "paste_bboxes": None,
                 "paste_keypoints": None,
+                "occluded_masks": None,
                 "objs_to_paste": []
             }
 
@@ -181,13 +208,11 @@ class CopyPaste(A.DualTransform):
             mask_indices = [bbox[-1] for bbox in bboxes]
 
         #create alpha by combining all the objects into
-        #a single binary mask
-        masks = [masks[int(idx)] for idx in mask_indices]
-
-        alpha = masks[0] > 0
-        for mask in masks[1:]:
-            alpha += mask > 0
+        #a single binary mask, only the selected masks are decoded if masks are lazy
+        masks = np.stack([np.asarray(masks[int(ix)]) for ix in mask_indices])
+        alpha = masks.any(axis=0)
 
+        #occlusion of the masks is shared by the masks and bboxes targets
         return {
             "param_masks": params["masks"],
             "paste_img": image,
@@ -195,7 +220,8 @@ class CopyPaste(A.DualTransform):
             "paste_mask": None,
             "paste_masks": masks,
             "paste_bboxes": bboxes,
-            "paste_keypoints": keypoints
+            "paste_keypoints": keypoints,
+            "occluded_masks": occlude_masks(params["masks"], alpha),
         }
 
     @property
@@ -229,11 +255,11 @@ class CopyPaste(A.DualTransform):
     def apply_to_mask(self, mask, paste_mask, alpha, **params):
         return mask_copy_paste(mask, paste_mask, alpha)
 
-    def apply_to_masks(self, masks, paste_masks, alpha, **params):
-        return masks_copy_paste(masks, paste_masks, alpha)
+    def apply_to_masks(self, masks, paste_masks, alpha, occluded_masks=None, **params):
+        return masks_copy_paste(masks, paste_masks, alpha, occluded_masks)
 
-    def apply_to_bboxes(self, bboxes, paste_bboxes, param_masks, paste_masks, alpha, key, **params):
-        return bboxes_copy_paste(bboxes, paste_bboxes, param_masks, paste_masks, alpha, key)
+    def apply_to_bboxes(self, bboxes, paste_bboxes, param_masks, paste_masks, alpha, key, occluded_masks=None, **params):
+        return bboxes_copy_paste(bboxes, paste_bboxes, param_masks, paste_masks, alpha, key, occluded_masks)
 
     def apply_to_keypoints(self, keypoints, paste_keypoints, alpha, **params):
         raise NotImplementedError
@@ -247,6 +273,51 @@ class CopyPaste(A.DualTransform):
             "max_paste_objects"
         )
 
+class ExampleCache(object):
+    """ LRU cache of loaded examples, evicting the least recently used ones above `max_bytes`.
+
+    Every process (e.g. every DataLoader worker) keeps its own cache.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.pid = os.getpid()
+        self._examples = OrderedDict()
+
+    @staticmethod
+    def example_nbytes(example):
+        masks = example.get('masks')
+        #lazily decoded masks know their size, lists of masks are summed up
+        arrays = [example.get('image')] + ([masks] if hasattr(masks, 'nbytes') else list(masks or []))
+        return sum(x.nbytes for x in arrays if hasattr(x, 'nbytes'))
+
+    def __len__(self):
+        return len(self._examples)
+
+    def get(self, idx):
+        if idx not in self._examples:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._examples.move_to_end(idx)
+        return self._examples[idx][0]
+
+    def put(self, idx, example):
+        nbytes = self.example_nbytes(example)
+        if nbytes > self.max_bytes or idx in self._examples:
+            return
+        self._examples[idx] = (example, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self._examples.popitem(last=False)
+            self.nbytes -= evicted
+
+    def sample(self, exclude=None):
+        #random index of a cached example other than `exclude`
+        return random.choice([idx for idx in self._examples.keys() if idx != exclude])
+
 def copy_paste_class(dataset_class):
     def _split_transforms(self):
         split_index = None
@@ -290,15 +361,44 @@ def copy_paste_class(dataset_class):
             self.copy_paste = None
             self.post_transforms = None
 
+    def _example_cache(self):
+        #every worker caches examples on its own, a cache inherited by a fork is replaced
+        max_bytes = getattr(self, 'example_cache_bytes', 0)
+        if not max_bytes or not hasattr(self, 'load_raw_example'):
+            return None
+        cache = getattr(self, '_cache', None)
+        if cache is None or cache.pid != os.getpid():
+            cache = self._cache = ExampleCache(max_bytes)
+        return cache
+
+    def _load_example(self, idx, cache):
+        #untransformed examples are cached, so they are augmented anew every time
+        if cache is None:
+            return self.load_example(idx)
+        example = cache.get(idx)
+        if example is None:
+            example = self.load_raw_example(idx)
+            cache.put(idx, example)
+        return self.transforms(**example)
+
+    def _sample_paste_index(self, idx, cache):
+        #with probability `partner_reuse` the partner is one of the cached examples, trading
+        #diversity of partners for fewer decoded images
+        reuse = getattr(self, 'partner_reuse', 0)
+        if cache is not None and len(cache) > 1 and random.random() < reuse:
+            return cache.sample(exclude=idx)
+        return random.randint(0, self.__len__() - 1)
+
     def __getitem__(self, idx):
         #split transforms if it hasn't been done already
         if not hasattr(self, 'post_transforms'):
             self._split_transforms()
 
-        img_data = self.load_example(idx)
+        cache = self._example_cache()
+        img_data = self._load_example(idx, cache)
         if self.copy_paste is not None:
-            paste_idx = random.randint(0, self.__len__() - 1)
-            paste_img_data = self.load_example(paste_idx)
+            paste_idx = self._sample_paste_index(idx, cache)
+            paste_img_data = self._load_example(paste_idx, cache)
             for k in list(paste_img_data.keys()):
                 paste_img_data['paste_' + k] = paste_img_data[k]
                 del paste_img_data[k]
@@ -310,6 +410,9 @@ def copy_paste_class(dataset_class):
         return img_data
 
     setattr(dataset_class, '_split_transforms', _split_transforms)
+    setattr(dataset_class, '_example_cache', _example_cache)
+    setattr(dataset_class, '_load_example', _load_example)
+    setattr(dataset_class, '_sample_paste_index', _sample_paste_index)
     setattr(dataset_class, '__getitem__', __getitem__)
 
     return dataset_class
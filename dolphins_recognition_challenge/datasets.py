@@ -1,7 +1,8 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: notebooks/01_Datasets.ipynb (unless otherwise specified).
 
 __all__ = ['ToTensor', 'stack_imgs', 'display_batches', 'get_image2tensor_transforms', 'get_dataset', 'Compose',
-           'RandomHorizontalFlip', 'CopyPasteAugmentation']
+           'RandomHorizontalFlip', 'CopyPasteAugmentation', 'PackedMasks', 'GroupedBatchSampler', 'LoadingStats',
+           'BatchAugmentation']
 
 # Cell
 
@@ -11,11 +12,20 @@ from typing import *
 # Internal Cell
 
 import sys
+import os
+import json
+import threading
+import time
+import warnings
 import numpy as np
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from collections import Counter, defaultdict
 from datetime import datetime
 import torch
 import torch.utils.data
+import torch.utils.data.distributed
 from torch.hub import download_url_to_file
 import torchvision
 import PIL
@@ -24,8 +34,8 @@ from zipfile import ZipFile
 import random
 import sys
 from pathlib import Path
-import random
 import albumentations as A
+from albumentations.augmentations.functional import shift_hsv
 from albumentations.pytorch.transforms import ToTensorV2
 import cv2
 from skimage.color import label2rgb
@@ -40,9 +50,10 @@ from torchvision.transforms import ToPILImage
 from tempfile import TemporaryDirectory
 
 from dolphins_recognition_challenge import utils
+from dolphins_recognition_challenge.sample_cache import DiskSampleCache, SharedSampleStore, TieredSampleCache, sample_key
+from dolphins_recognition_challenge.zip_reader import ZipMember, ZipRoot
 from torch.utils.data import Dataset
-sys.path.insert(1, 'dolphins_recognition_challenge')
-from copy_paste import CopyPaste
+from dolphins_recognition_challenge.copy_paste import CopyPaste
 
 
 # Internal Cell
@@ -54,7 +65,29 @@ dataset_url = "https://s3.eu-central-1.amazonaws.com/ai-league.cisex.org/2020-20
 dataset_root = Path("./data/dolphins_200_train_val")
 dataset_zip = dataset_root.parent / "dolphins_200_train_val.zip"
 
-def _download_data_if_needed():
+_extract_manifest_fname = ".extracted.json"
+
+def _is_extracted(manifest_path: Path, zip_signature: List[int]) -> bool:
+    """Checks if the manifest belongs to the current zip file and all extracted files are still in place"""
+    try:
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["zip"] != zip_signature:
+            return False
+        for fname, size in manifest["files"]:
+            if (dataset_root / fname).stat().st_size != size:
+                return False
+        return True
+    except (OSError, ValueError, KeyError):
+        return False
+
+def _n_extracted_files() -> int:
+    """Number of files extracted from the zip file, as recorded in the manifest of the extraction"""
+    try:
+        return len(json.loads((dataset_root / _extract_manifest_fname).read_text())["files"])
+    except (OSError, ValueError, KeyError):
+        return 0
+
+def _download_data_if_needed(extract: bool=True):
 
     dataset_zip.parent.mkdir(parents=True, exist_ok=True)
 
@@ -66,57 +99,163 @@ def _download_data_if_needed():
             progress=True,
         )
 
+    if not extract:
+        return
+
+    # skip extraction if the manifest written after the last extraction shows that all files are in place
+    st = dataset_zip.stat()
+    zip_signature = [st.st_mtime_ns, st.st_size]
+    manifest_path = dataset_root / _extract_manifest_fname
+    if _is_extracted(manifest_path, zip_signature):
+        return
 
     with ZipFile(dataset_zip, 'r') as zip_ref:
         zip_ref.extractall(dataset_root)
+        files = [[info.filename, info.file_size] for info in zip_ref.infolist() if not info.is_dir()]
+
+    manifest_path.write_text(json.dumps({"zip": zip_signature, "files": files}))
+
+
+# Internal Cell
 
 
+def _open_image(fname: Union[Path, ZipMember]) -> Image.Image:
+    """Opens an image stored either in a file or in a zip archive"""
+    return Image.open(fname) if isinstance(fname, Path) else Image.open(fname.open("rb"))
+
+def _imread_rgb(fname: Union[Path, ZipMember]) -> np.array:
+    """Decodes an image stored either in a file or in a zip archive into an RGB array"""
+    if isinstance(fname, Path):
+        img = cv2.imread(str(fname), 1)
+    else:
+        img = cv2.imdecode(np.frombuffer(fname.read_bytes(), dtype=np.uint8), 1)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+def _sidecar_path(root: Union[Path, ZipRoot], name: str) -> Path:
+    """Path of a small metadata file stored next to the dataset"""
+    return root.sidecar_path(name) if isinstance(root, ZipRoot) else Path(root) / name
+
 # Internal Cell
 
 
 def _enumerate_colors_for_fname(fname: Path) -> Tuple[int, int, int]:
     """Finds all colors in the image"""
-    img = Image.open(fname)
+    img = _open_image(fname)
     colors = [y for x, y in img.getcolors()]
     return colors
 
 # Internal Cell
 
 
-def _enumerate_colors_for_fnames(fnames: List[Path]) -> Dict[Tuple[int, int, int], int]:
+def _map_files(f: Callable[[Any], Any], items: List[Any], max_workers: Optional[int]=None) -> List[Any]:
+    """Applies `f` to independent files, in a process pool if there are enough of them"""
+    if max_workers == 1 or len(items) < 2 * (os.cpu_count() or 1):
+        return [f(x) for x in items]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(f, items, chunksize=8))
+
+def _enumerate_colors_for_fnames(fnames: List[Path], max_workers: Optional[int]=None) -> Dict[Tuple[int, int, int], int]:
     """This function is used to pin (0, 0, 0) color to the front of palette"""
-    colors = np.array([_enumerate_colors_for_fname(fname) for fname in fnames]).reshape(
-        -1, 3
-    )
-    colors = set([tuple(x) for x in colors.tolist() if tuple(x) != (0, 0, 0)])
+    colors_for_fnames = _map_files(_enumerate_colors_for_fname, fnames, max_workers)
+    colors = [tuple(x) for colors_for_fname in colors_for_fnames for x in colors_for_fname]
+    colors = set([x for x in colors if x != (0, 0, 0)])
     colors = [(0, 0, 0)] + list(colors)
     return {x: i for i, x in enumerate(colors)}
 
 # Internal Cell
 
+_class_colors_sidecar = ".class_colors.json"
+
+def _files_signature(fnames: List[Path]) -> List[Tuple[str, int, int]]:
+    """Returns (name, mtime, size) for each of the files"""
+    signature = []
+    for fname in fnames:
+        st = fname.stat()
+        signature.append([fname.name, st.st_mtime_ns, st.st_size])
+    return signature
 
-def _substitute_values(xs: np.array, x, y):
-    """Not sure I understand what this does"""
-    ix_x = xs == x
-    ix_y = xs == y
-    xs[ix_x] = y
-    xs[ix_y] = x
+def _load_or_enumerate_class_colors(root: Path, fnames: List[Path]) -> Dict[Tuple[int, int, int], int]:
+    """Enumerates colors of class labels and stores them in a sidecar file next to the dataset.
+
+    The stored colors are reused as long as the list of label files and their mtimes and sizes are unchanged.
+    Label files are checked on their own, the manifest does not notice files overwritten in place.
+    """
+    sidecar = _sidecar_path(root, _class_colors_sidecar)
+    signature = _files_signature(fnames)
+    try:
+        cached = json.loads(sidecar.read_text())
+        if cached["files"] == signature:
+            return {tuple(x): i for i, x in enumerate(cached["colors"])}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    class_colors = _enumerate_colors_for_fnames(fnames)
+
+    try:
+        tmp_sidecar = sidecar.with_name(f"{sidecar.name}.{os.getpid()}.tmp")
+        tmp_sidecar.write_text(json.dumps({"files": signature, "colors": [list(x) for x in class_colors]}))
+        os.replace(tmp_sidecar, sidecar)
+    except OSError:
+        # dataset directory is read-only, colors will be enumerated again next time
+        pass
+
+    return class_colors
+
+# Internal Cell
+
+
+def _pack_rgb(xs: np.array) -> np.array:
+    """Packs RGB colors from the last axis into one uint32 key per color"""
+    keys = xs[..., 0].astype(np.uint32)
+    keys <<= 8
+    keys |= xs[..., 1]
+    keys <<= 8
+    keys |= xs[..., 2]
+    return keys
 
 # Internal Cell
 
 
-def _enumerate_image_for_instances(
-    im: Image, force_black_to_zero: bool = True, max_colors=16
+def _enumerate_colors_with_lookup(
+    im: Image, color_keys: np.array, ids: np.array, dtype=np.uint8
 ) -> np.array:
-    """convert rgb image mask to enumerated image mask"""
-    pallete_mask = im.convert("P", palette=Image.ADAPTIVE, colors=max_colors)
+    """Maps every pixel of the image to the id of its color, colors not in `color_keys` are mapped to 0.
+
+    The lookup table covers all 2^24 colors, but only pages holding the used colors are ever touched.
+    """
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    keys = _pack_rgb(np.asarray(im))
+
+    lut = np.zeros(1 << 24, dtype=dtype)
+    lut[color_keys] = ids
+    return lut[keys]
+
+# Internal Cell
 
-    xs = np.array(pallete_mask)
 
-    if force_black_to_zero:
-        _substitute_values(xs, 0, xs.max())
+def _getcolors(im: Image) -> List[Tuple[int, Tuple[int, int, int]]]:
+    """Returns (count, color) of all colors in the image. Cost of `getcolors` grows with `maxcolors`,
+    so a small limit is tried first."""
+    colors = im.getcolors(maxcolors=256)
+    if colors is None:
+        colors = im.getcolors(maxcolors=im.width * im.height)
+    return colors
+
+# Internal Cell
 
-    return xs
+
+def _enumerate_image_for_instances(im: Image) -> np.array:
+    """convert rgb image mask to enumerated image mask, background (black) is always 0"""
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    colors = np.array([color for _, color in _getcolors(im)], dtype=np.uint8).reshape(-1, 3)
+    color_keys = np.sort(_pack_rgb(colors))
+    color_keys = color_keys[color_keys != 0]
+    ids = np.arange(1, len(color_keys) + 1)
+
+    dtype = np.uint8 if len(color_keys) < 256 else np.uint16
+    return _enumerate_colors_with_lookup(im, color_keys, ids, dtype)
 
 # Internal Cell
 
@@ -126,69 +265,192 @@ def _enumerate_image_for_classes(
     colors: Dict[Tuple[int], int] = None,
 ) -> np.array:
     """Enumerates classes from the rbg format"""
-    xs = np.array(im)
-    xs = [
-        ((xs == color).all(axis=-1)).astype(int) * code
-        for color, code in colors.items()
-    ]
-    xs_sum = xs[0]
-    for i in range(1, len(xs)):
-        xs_sum = xs_sum + xs[i]
-    return xs_sum.astype("uint8")
+    color_keys = _pack_rgb(np.array(list(colors.keys()), dtype=np.uint8).reshape(-1, 3))
+    ids = np.array(list(colors.values()))
+    return _enumerate_colors_with_lookup(im, color_keys, ids, np.uint8)
 
 # Internal Cell
 
-def get_data(idx, img_path, label_path, mask_path, class_colors):
+def _extract_instances(mask: np.array, label_array: np.array) -> Tuple[np.array, np.array, np.array, np.array]:
+    """Finds ids, bounding boxes (xmin, ymin, xmax, ymax), areas and majority classes of all instances.
+
+    Everything is computed in one pass over the instance map, so the cost does not grow with the number of instances.
+    """
+    height, width = mask.shape
+    n_ids = int(mask.max()) + 1
+
+    # flags of instances present in each row and in each column
+    in_rows = np.zeros((height, n_ids), dtype=bool)
+    in_rows[np.arange(height)[:, None], mask] = True
+    in_cols = np.zeros((width, n_ids), dtype=bool)
+    in_cols[np.arange(width)[None, :], mask] = True
+
+    areas = np.bincount(mask.ravel(), minlength=n_ids)
+
+    # first id is the background, so remove it
+    obj_ids = np.flatnonzero(areas[1:]) + 1
+    in_rows = in_rows[:, obj_ids]
+    in_cols = in_cols[:, obj_ids]
+
+    ymin = in_rows.argmax(axis=0)
+    ymax = height - 1 - in_rows[::-1].argmax(axis=0)
+    xmin = in_cols.argmax(axis=0)
+    xmax = width - 1 - in_cols[::-1].argmax(axis=0)
+    boxes = np.column_stack([xmin, ymin, xmax, ymax])
+
+    # count classes of foreground pixels for each instance, background class is never the majority
+    n_classes = int(label_array.max()) + 1
+    fg = mask != 0
+    class_counts = np.bincount(
+        mask[fg].astype(np.int64) * n_classes + label_array[fg], minlength=n_ids * n_classes
+    ).reshape(n_ids, n_classes)
+    class_counts[:, 0] = 0
+    labels = class_counts.argmax(axis=1)
+
+    return obj_ids, boxes, areas[obj_ids], labels[obj_ids]
+
+# Cell
+
+class LoadingStats(object):
+    """ Per-stage timers and counters of sample loading, aggregated over all DataLoader workers.
+
+    Every worker accumulates into its own row of a tensor in shared memory, so workers never wait for each other
+    and totals are read by summing the rows. Threads of one process share a row guarded by a lock.
+    """
+    fields = (
+        "samples", "bytes", "decode_ms", "png_ms", "quantize_ms", "cache_hits", "cache_misses",
+        "partner_ms", "partner_fallbacks", "augment_ms", "to_tensor_ms",
+    )
+
+    def __init__(self, max_workers: int=64):
+        # row 0 is used by the main process, row i + 1 by the worker i
+        self.counters = torch.zeros((max_workers + 1, len(self.fields)), dtype=torch.float64).share_memory_()
+        self._index = {field: i for i, field in enumerate(self.fields)}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _row(self) -> int:
+        info = torch.utils.data.get_worker_info()
+        row = 0 if info is None else info.id + 1
+        assert row < len(self.counters), f"LoadingStats has rows for {len(self.counters) - 1} workers only"
+        return row
+
+    def add(self, field: str, value: float=1) -> None:
+        """Adds `value` to the counter `field` of the current worker"""
+        row, col = self._row(), self._index[field]
+        with self._lock:
+            self.counters[row, col] += value
+
+    @contextmanager
+    def timer(self, field: str):
+        """Adds milliseconds spent in the block to the counter `field`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(field, (time.perf_counter() - start) * 1000)
+
+    def totals(self) -> Dict[str, float]:
+        """Returns counters summed over all workers"""
+        return dict(zip(self.fields, self.counters.sum(dim=0).tolist()))
+
+    @staticmethod
+    def per_sample(totals: Dict[str, float], start: Optional[Dict[str, float]]=None) -> Dict[str, float]:
+        """Returns averages per sample of counters accumulated between `start` and `totals`"""
+        if start is not None:
+            totals = {k: v - start[k] for k, v in totals.items()}
+        n_samples = totals.pop("samples")
+        return {k: v / n_samples for k, v in totals.items()} if n_samples > 0 else {}
+
+    def summary(self, start: Optional[Dict[str, float]]=None) -> str:
+        """Formats totals and averages per sample accumulated since `start`"""
+        totals = self.totals()
+        n_samples = totals["samples"] - (start["samples"] if start is not None else 0)
+        averages = self.per_sample(totals, start)
+        return "{:.0f} samples, ".format(n_samples) + ", ".join("{}: {:.3f}".format(k, v) for k, v in averages.items())
+
+    def reset(self) -> None:
+        self.counters.zero_()
+
+# Internal Cell
+
+def _timer(stats: Optional[LoadingStats], field: str):
+    return stats.timer(field) if stats is not None else nullcontext()
+
+# Internal Cell
+
+def _decode_sample(idx, img_path, label_path, mask_path, class_colors, stats=None):
+    """Decodes image and annotations of a sample into (image, instances, obj_ids, boxes, labels) arrays"""
 
     # load and transform images and masks
-    img = cv2.imread(str(img_path), 1)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    dim = (500, 750)
-    #img = cv2.resize(img, dim, interpolation = cv2.INTER_AREA)
+    with _timer(stats, "decode_ms"):
+        img = _imread_rgb(img_path)
 
-    height, width, channels = img.shape
-    MAX_SIZE = 500
+    with _timer(stats, "png_ms"):
+        mask_img = _open_image(mask_path)
+        label_img = _open_image(label_path)
+        mask_img.load()
+        label_img.load()
 
-    mask_img = Image.open(mask_path)
-    #mask_img = mask_img.resize(dim)
-    label_img = Image.open(label_path)
-    #label_img = label_img.resize(dim)
+    with _timer(stats, "quantize_ms"):
+        mask = _enumerate_image_for_instances(mask_img)
+        label_array = _enumerate_image_for_classes(label_img, class_colors)
 
-    mask = _enumerate_image_for_instances(mask_img)
+        # get bounding box coordinates and labels of all instances at once
+        obj_ids, obj_boxes, _, obj_labels = _extract_instances(mask, label_array)
 
-    # instances are encoded as different colors
-    obj_ids = np.unique(mask)
+    # keep only instances with non-degenerated boxes
+    xmin, ymin, xmax, ymax = obj_boxes.T
+    keep = (xmax > xmin) & (ymax > ymin)
+    for _ in range(np.count_nonzero(~keep)):
+        print("removing: ", idx)
 
-    # first id is the background, so remove it
-    obj_ids = obj_ids[1:]
+    num_objs = len(obj_ids)
+    boxes = np.column_stack([obj_boxes, np.ones(num_objs), np.arange(num_objs)])[keep].astype(np.float32)
+    labels = obj_labels[keep]
+
+    return img, mask, obj_ids, boxes, labels
+
+# Internal Cell
+
+def get_data(idx, img_path, label_path, mask_path, class_colors, cache=None, stats=None):
+    """Loads a sample. The `cache` can be any object with `get` and `put` methods, like `DiskSampleCache`,
+    `SharedSampleStore` or `TieredSampleCache`. Time spent decoding is recorded in `stats`, if given."""
+
+    # decode the sample or read it from the cache if it was decoded before
+    sample = None
+    if cache is not None:
+        key = sample_key([img_path, label_path, mask_path], extra=sorted(class_colors.items()))
+        sample = cache.get(key)
+        if stats is not None:
+            stats.add("cache_hits" if sample is not None else "cache_misses")
+    if sample is None:
+        sample = _decode_sample(idx, img_path, label_path, mask_path, class_colors, stats)
+        if cache is not None:
+            cache.put(key, sample)
+
+    return _sample_from_decoded(idx, sample)
+
+# Internal Cell
+
+def _sample_from_decoded(idx, sample):
+    """Turns decoded (image, instances, obj_ids, boxes, labels) arrays into (img, boxes, masks, labels, image_id,
+    area, iscrowd) of a sample"""
+    img, mask, obj_ids, boxes, _ = sample
 
     # split the color-encoded mask into a set
     # of binary masks
-    masks = mask == obj_ids[:, None, None]
-    masks = 1*masks
-    label_array = _enumerate_image_for_classes(label_img, class_colors)
+    masks = (mask == obj_ids[:, None, None]).view(np.uint8)
 
-    # get bounding box coordinates for each mask
     num_objs = len(obj_ids)
-    #print("num_objects", num_objs)
-    boxes = []
-    labels = []
-    for i in range(num_objs):
-        pos = np.where(masks[i])
-        xmin = np.min(pos[1])
-        xmax = np.max(pos[1])
-        ymin = np.min(pos[0])
-        ymax = np.max(pos[0])
-        if xmax > xmin and ymax > ymin:
-            boxes.append([xmin, ymin, xmax, ymax, 1, i])
-            class_mask = label_array * masks[i]
-            label, count = np.unique(class_mask, return_counts=True)
-            assert label.shape[0] <= 2
-            label = max(label)
-            labels.append(label)
-        else:
-            print("removing: ", idx)
-
     boxes = torch.as_tensor(boxes, dtype=torch.float32)
     # there WAS multi class
     # labels = torch.as_tensor(labels, dtype=torch.int64)
@@ -202,79 +464,425 @@ def get_data(idx, img_path, label_path, mask_path, class_colors):
     return img, boxes, masks, labels, image_id, area, iscrowd
 
 
-class DolphinsInstanceSegmentationDataset(torch.utils.data.Dataset):
-    """Instance segmentation dataset"""
+# Internal Cell
 
-    def __init__(
-        self,
-        root: Path,
-        tensor_transforms: Optional[Callable[[Image.Image], Any]]=None,
-        n_samples: int=-1
-    ):
-        self.root = root
-        self.tensor_transforms = tensor_transforms
-        # load all image files, sorting them to
-        # ensure that they are aligned
-        self.img_paths = sorted((root / "JPEGImages").glob("*.*"))[:n_samples]
-        self.label_paths = sorted((root / "SegmentationClass").glob("*.*"))[:n_samples]
-        self.mask_paths = sorted((root / "SegmentationObject").glob("*.*"))[:n_samples]
+def _image_shape_from_header(fname: Path) -> Tuple[int, int]:
+    """Reads (height, width) of the image from its header without decoding pixels.
 
-        self.class_colors = _enumerate_colors_for_fnames(self.label_paths)
+    EXIF orientation is taken into account the same way as `cv2.imread` does it.
+    """
+    with _open_image(fname) as img:
+        width, height = img.size
+        orientation = img.getexif().get(0x0112, 1)
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return height, width
 
-    def __getitem__(self, idx):
+# Internal Cell
+
+_manifest_sidecar = ".manifest.npz"
+
+# subdirectories holding images, class labels and instance masks
+_manifest_dirs = ("JPEGImages", "SegmentationClass", "SegmentationObject")
+
+def _dirs_signature(root: Union[Path, ZipRoot]) -> np.array:
+    """Modification times of the dataset subdirectories, they change whenever a file is added, removed or renamed"""
+    return np.array([(root / d).stat().st_mtime_ns for d in _manifest_dirs], dtype=np.int64)
+
+def _count_instances(fname: Path) -> int:
+    """Counts instances in the instance mask, background (black) is not an instance"""
+    with _open_image(fname) as im:
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        return sum(1 for _, color in _getcolors(im) if color != (0, 0, 0))
+
+def _manifest_row(fnames: Tuple[Path, Path, Path]) -> Tuple[Tuple[int, int], int, List[int], List[int]]:
+    """Returns (height, width), number of instances, mtimes and sizes of the files of a sample"""
+    img_path, _, mask_path = fnames
+    stats = [fname.stat() for fname in fnames]
+    return (
+        _image_shape_from_header(img_path),
+        _count_instances(mask_path),
+        [st.st_mtime_ns for st in stats],
+        [st.st_size for st in stats],
+    )
+
+def _build_manifest(root: Union[Path, ZipRoot]) -> Dict[str, np.array]:
+    """Indexes samples of the dataset, files of a sample are matched by their stem"""
+    names_by_stem = [{fname.stem: fname.name for fname in (root / d).glob("*.*")} for d in _manifest_dirs]
+    stems = sorted(set.intersection(*[set(names) for names in names_by_stem]))
+    names = [[names[stem] for stem in stems] for names in names_by_stem]
+
+    rows = _map_files(_manifest_row, [tuple(root / d / n for d, n in zip(_manifest_dirs, ns)) for ns in zip(*names)])
+    shapes, n_instances, mtimes, sizes = zip(*rows) if len(rows) > 0 else ([], [], [], [])
+
+    return dict(
+        stems=np.array(stems, dtype=str),
+        img_names=np.array(names[0], dtype=str),
+        label_names=np.array(names[1], dtype=str),
+        mask_names=np.array(names[2], dtype=str),
+        shapes=np.array(shapes, dtype=np.int32).reshape(-1, 2),
+        n_instances=np.array(n_instances, dtype=np.int32),
+        mtimes=np.array(mtimes, dtype=np.int64).reshape(-1, 3),
+        sizes=np.array(sizes, dtype=np.int64).reshape(-1, 3),
+    )
+
+def _load_or_build_manifest(root: Union[Path, ZipRoot]) -> Dict[str, np.array]:
+    """Loads the index of samples from a sidecar file next to the dataset, building it first if needed.
+
+    The stored manifest is reused as long as modification times of the dataset subdirectories (or of the
+    zip archive) are unchanged.
+    """
+    sidecar = _sidecar_path(root, _manifest_sidecar)
+    signature = _dirs_signature(root)
+    try:
+        with np.load(sidecar) as f:
+            manifest = dict(f)
+        if np.array_equal(manifest.pop("signature"), signature):
+            return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+
+    manifest = _build_manifest(root)
+
+    try:
+        tmp_sidecar = sidecar.with_name(f"{sidecar.name}.{os.getpid()}.tmp")
+        with open(tmp_sidecar, "wb") as f:
+            np.savez(f, signature=signature, **manifest)
+        os.replace(tmp_sidecar, sidecar)
+    except OSError:
+        # dataset directory is read-only, the manifest will be built again next time
+        pass
+
+    return manifest
+
+# Internal Cell
+
+def _group_by_shape(shapes: np.array) -> Dict[Tuple[int, int], np.array]:
+    """Groups indices of images by their (height, width)"""
+    groups = defaultdict(list)
+    for i, shape in enumerate(shapes.tolist()):
+        groups[tuple(shape)].append(i)
+    return {shape: np.array(ixs) for shape, ixs in groups.items()}
+
+# Internal Cell
+
+def _resize_paste_partner(img, boxes, masks, shape):
+    """Resizes image, boxes and masks of a paste partner to the given (height, width)"""
+    height, width = shape
+    height_b, width_b = img.shape[:2]
+
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    # nearest neighbour resizing of all masks at once
+    rows = np.arange(height) * height_b // height
+    cols = np.arange(width) * width_b // width
+    masks = masks[:, rows[:, None], cols]
+
+    boxes = boxes.clone()
+    boxes[:, [0, 2]] *= width / width_b
+    boxes[:, [1, 3]] *= height / height_b
+
+    return img, boxes, masks
+
+
+# Cell
 
-        img_path = self.img_paths[idx]
-        label_path = self.label_paths[idx]
-        mask_path = self.mask_paths[idx]
-        img, boxes, masks, labels, image_id, area, iscrowd = get_data(idx, img_path, label_path, mask_path, self.class_colors)
+class PackedMasks(object):
+    """ Instance masks packed to one bit per pixel.
 
-        while True:
-            idx_b = random.randint(0,len(self.img_paths)-1)
-            img_path_b = self.img_paths[idx_b]
-            label_path_b = self.label_paths[idx_b]
-            mask_path_b = self.mask_paths[idx_b]
-            img_b, boxes_b, masks_b, labels_b, image_id_b, area_b, iscrowd_b = get_data(idx_b, img_path_b, label_path_b, mask_path_b, self.class_colors)
-            if img_b.shape == img.shape:
-                break
+    Packed masks are much cheaper to send from DataLoader workers than dense ones. They can stay in a target
+    in place of the dense masks tensor: `to(device)` unpacks them on the device, just before they are fed to the model.
+    """
+    def __init__(self, packed: torch.Tensor, shape: Tuple[int, int, int]):
+        self.packed = packed
+        self._shape = tuple(shape)
+
+    @classmethod
+    def from_dense(cls, masks, image_shape: Optional[Tuple[int, int]]=None) -> "PackedMasks":
+        """Packs N x H x W masks. An empty list of masks has no shape, so `image_shape` (H, W) must be given then."""
+        if isinstance(masks, torch.Tensor):
+            masks = masks.numpy()
+        masks = np.asarray(masks)
+        if masks.ndim != 3:
+            assert masks.size == 0 and image_shape is not None, f"masks should be N x H x W, but their shape is {masks.shape}."
+            masks = masks.reshape(0, *image_shape)
+        n, height, width = masks.shape
+        packed = np.packbits(masks.reshape(n, height * width) != 0, axis=1)
+        return cls(torch.from_numpy(packed), masks.shape)
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size(self._shape)
+
+    def __len__(self):
+        return self._shape[0]
+
+    def unpack(self, device: Optional[torch.device]=None, non_blocking: bool=False) -> torch.Tensor:
+        """Returns dense N x H x W uint8 masks on the device"""
+        n, height, width = self._shape
+        device = torch.device(device) if device is not None else self.packed.device
+        if device.type == "cpu":
+            masks = np.unpackbits(self.packed.cpu().numpy(), axis=1, count=height * width)
+            return torch.from_numpy(masks.reshape(n, height, width))
+
+        packed = self.packed.to(device, non_blocking=non_blocking)
+        shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=device)
+        masks = (packed.unsqueeze(-1) >> shifts) & 1
+        return masks.reshape(n, packed.shape[1] * 8)[:, :height * width].reshape(n, height, width)
+
+    def to(self, device: torch.device, non_blocking: bool=False) -> torch.Tensor:
+        return self.unpack(device, non_blocking=non_blocking)
 
-        if self.tensor_transforms is not None and len(self.tensor_transforms.transforms.transforms)>0:
+    def __repr__(self):
+        return f"PackedMasks(shape={self._shape})"
 
+# Internal Cell
+
+def _image_to_tensor(img: np.array, dtype: torch.dtype=torch.float32) -> torch.Tensor:
+    """Converts an H x W x C uint8 image into a C x H x W tensor with a single copy.
+
+    Floating point images are scaled to [0, 1] like `ToTensor` does it, uint8 images are kept as they are.
+    """
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        img = np.uint8(img)
+    with warnings.catch_warnings():
+        # memory-mapped samples are read-only, but they are only read from here
+        warnings.simplefilter("ignore", UserWarning)
+        src = torch.from_numpy(img)
+    height, width, n_channels = img.shape
+    tensor = torch.empty((n_channels, height, width), dtype=dtype)
+    tensor.copy_(src.permute(2, 0, 1))
+    if dtype.is_floating_point:
+        tensor.div_(255)
+    return tensor
+
+def _as_float_image(img: torch.Tensor) -> torch.Tensor:
+    """Scales uint8 image tensors to floats in [0, 1], float tensors are returned unchanged"""
+    return img.float().div_(255) if img.dtype == torch.uint8 else img
+
+# Internal Cell
 
-            boxes = [box.tolist() for box in boxes]
-            boxes_b = [box.tolist() for box in boxes_b]
+def _densify_masks(masks) -> torch.Tensor:
+    return masks.unpack() if isinstance(masks, PackedMasks) else masks
+
+
+# Internal Cell
+
+def _has_transforms(tensor_transforms) -> bool:
+    return tensor_transforms is not None and len(tensor_transforms.transforms.transforms)>0
+
+def _needs_paste_partner(tensor_transforms) -> bool:
+    """Checks if the transforms contain `CopyPaste`, which pastes objects from a second sample"""
+    return _has_transforms(tensor_transforms) and any(
+        t.get_class_fullname() == CopyPaste.get_class_fullname() for t in tensor_transforms.transforms.transforms
+    )
+
+def _make_example(sample, partner, tensor_transforms, pack_masks, image_dtype, stats=None):
+    """Augments a loaded sample, with its copy-paste `partner` if not `None`, and turns it into an (image, target) pair"""
+    img, boxes, masks, labels, image_id, area, iscrowd = sample
+
+    if _has_transforms(tensor_transforms):
+
+        paste = {}
+        if partner is not None:
+            img_b, boxes_b, masks_b = partner
+            paste = dict(paste_image=img_b, paste_masks=masks_b, paste_bboxes=[box.tolist() for box in boxes_b])
+
+        boxes = [box.tolist() for box in boxes]
+        with _timer(stats, "augment_ms"):
             try:
-                augmented = self.tensor_transforms(image=img, masks=masks, bboxes=boxes, paste_image = img_b, paste_masks=masks_b, paste_bboxes=boxes_b, category_id=labels)
+                augmented = tensor_transforms(image=img, masks=masks, bboxes=boxes, category_id=labels, **paste)
                 img = augmented['image']
                 masks = augmented['masks']
                 boxes = augmented['bboxes']
+                # copy-paste adds and removes objects, like in `_sample_from_decoded` all of them are of the same class
+                labels = torch.ones((len(masks),), dtype=torch.int64)
+                iscrowd = torch.zeros((len(masks),), dtype=torch.int64)
+                area = None
             except:
               pass
 
+    else:
+      boxes = boxes.tolist()
+    boxes = [box[:4] for box in boxes]
+    boxes = torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4)
+    if area is None:
+        area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+
+    with _timer(stats, "to_tensor_ms"):
+        if pack_masks:
+            masks = PackedMasks.from_dense(masks, image_shape=img.shape[:2])
         else:
-          boxes = boxes.tolist()
-        boxes = [box[:4] for box in boxes]
-        boxes = torch.as_tensor(boxes, dtype=torch.float32)
+            masks = torch.as_tensor(masks, dtype=torch.uint8)
+        img = _image_to_tensor(img, image_dtype)
 
-        masks = torch.as_tensor(masks, dtype=torch.uint8)
+    target = {}
 
+    target["boxes"] = boxes
+    target["labels"] = labels
+    target["masks"] = masks
+    target["image_id"] = image_id
+    target["area"] = area
+    target["iscrowd"] = iscrowd
 
-        target = {}
+    if stats is not None:
+        mask_bytes = masks.packed.nbytes if pack_masks else masks.nbytes
+        stats.add("bytes", img.nbytes + mask_bytes)
+        stats.add("samples")
 
-        target["boxes"] = boxes
-        target["labels"] = labels
-        target["masks"] = masks
-        target["image_id"] = image_id
-        target["area"] = area
-        target["iscrowd"] = iscrowd
+    return img, target
+
+
+class DolphinsInstanceSegmentationDataset(torch.utils.data.Dataset):
+    """Instance segmentation dataset
+
+    The `root` is either a directory or a `ZipRoot` pointing to a directory inside a zip archive.
+    Decoded samples are cached in `shared_store` (shared by all processes using it), in `cache_dir` on disk, or both.
+    If `pack_masks` is set, masks in targets are returned as `PackedMasks`.
+    Images are returned as C x H x W tensors of `image_dtype`, uint8 images are left to be scaled later, e.g. on the device.
+    If `stats` is given, time spent in every stage of loading is recorded in it.
 
+    Copy-paste partners are sampled among images of the same shape. If an image has a unique shape,
+    `paste_fallback` decides what happens: 'resize' resizes a random partner to the shape of the image and
+    'skip' skips pasting.
+    """
+
+    def __init__(
+        self,
+        root: Union[Path, ZipRoot],
+        tensor_transforms: Optional[Callable[[Image.Image], Any]]=None,
+        n_samples: int=-1,
+        cache_dir: Optional[Path]=None,
+        paste_fallback: str="resize",
+        pack_masks: bool=False,
+        shared_store: Optional[SharedSampleStore]=None,
+        image_dtype: torch.dtype=torch.float32,
+        stats: Optional[LoadingStats]=None,
+    ):
+        assert paste_fallback in ["resize", "skip"], f"paste_fallback should be either 'resize' or 'skip', but it is '{paste_fallback}'."
+
+        self.root = root
+        self.tensor_transforms = tensor_transforms
+        self.paste_fallback = paste_fallback
+        self.pack_masks = pack_masks
+        self.image_dtype = image_dtype
+        self.stats = stats
+        # decoded samples are cached in shared memory and/or on disk
+        caches = [shared_store] if shared_store is not None else []
+        if cache_dir is not None:
+            caches.append(DiskSampleCache(cache_dir))
+        self.cache = TieredSampleCache(caches) if len(caches) > 0 else None
+        # index of samples, kept in numpy arrays instead of lists of paths, so that forked
+        # workers do not copy pages of the index by touching reference counts
+        manifest = _load_or_build_manifest(root)
+        self.stems = manifest["stems"][:n_samples]
+        self.img_names = manifest["img_names"][:n_samples]
+        self.label_names = manifest["label_names"][:n_samples]
+        self.mask_names = manifest["mask_names"][:n_samples]
+        self.n_instances = manifest["n_instances"][:n_samples]
+
+        self.class_colors = _load_or_enumerate_class_colors(root, self.label_paths)
+
+        # index of image shapes used for sampling copy-paste partners
+        self.shapes = manifest["shapes"][:n_samples]
+        self.shape_groups = _group_by_shape(self.shapes)
+
+    def _sample_paths(self, idx: int) -> Tuple[Path, Path, Path]:
+        """Returns paths of the image, class labels and instance mask of a sample"""
+        return (
+            self.root / "JPEGImages" / str(self.img_names[idx]),
+            self.root / "SegmentationClass" / str(self.label_names[idx]),
+            self.root / "SegmentationObject" / str(self.mask_names[idx]),
+        )
+
+    @property
+    def img_paths(self) -> List[Path]:
+        return [self.root / "JPEGImages" / str(name) for name in self.img_names]
+
+    @property
+    def label_paths(self) -> List[Path]:
+        return [self.root / "SegmentationClass" / str(name) for name in self.label_names]
+
+    @property
+    def mask_paths(self) -> List[Path]:
+        return [self.root / "SegmentationObject" / str(name) for name in self.mask_names]
+
+    def _get_paste_partner(self, idx, img, boxes, masks):
+        """Returns image, boxes and masks of a random copy-paste partner of the same shape as the image `idx`"""
+        group = self.shape_groups[tuple(self.shapes[idx])]
+        if len(group) > 1:
+            idx_b = int(random.choice(group))
+        elif self.paste_fallback == "resize" and len(self) > 1:
+            idx_b = random.choice([i for i in range(len(self)) if i != idx])
+            if self.stats is not None:
+                self.stats.add("partner_fallbacks")
+        else:
+            # nothing to paste
+            if self.stats is not None:
+                self.stats.add("partner_fallbacks")
+            return img, boxes[:0], masks[:0]
+
+        img_b, boxes_b, masks_b, *_ = get_data(
+            idx_b, *self._sample_paths(idx_b), self.class_colors, self.cache, self.stats
+        )
+        if img_b.shape != img.shape:
+            img_b, boxes_b, masks_b = _resize_paste_partner(img_b, boxes_b, masks_b, img.shape[:2])
+
+        return img_b, boxes_b, masks_b
+
+    def __getitem__(self, idx):
 
-        img = Image.fromarray(np.uint8(img)).convert('RGB')
-        img = torchvision.transforms.ToTensor()(img)
+        img_path, label_path, mask_path = self._sample_paths(idx)
+        sample = get_data(idx, img_path, label_path, mask_path, self.class_colors, self.cache, self.stats)
 
-        return img, target
+        partner = None
+        if _needs_paste_partner(self.tensor_transforms):
+            img, boxes, masks, *_ = sample
+            with _timer(self.stats, "partner_ms"):
+                partner = self._get_paste_partner(idx, img, boxes, masks)
+
+        return _make_example(sample, partner, self.tensor_transforms, self.pack_masks, self.image_dtype, self.stats)
+
+    def __len__(self):
+        return len(self.img_names)
+
+# Cell
+
+class GroupedBatchSampler(torch.utils.data.Sampler):
+    """ Batches indices from `sampler` so that every batch contains only indices from the same group.
+
+    Order of the sampler is preserved within each group, so shuffling of the sampler is kept. Incomplete batches
+    of all groups are returned at the end of each epoch.
+    """
+    def __init__(self, sampler: torch.utils.data.Sampler, group_ids: List[int], batch_size: int):
+        self.sampler = sampler
+        self.group_ids = group_ids
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        batches = defaultdict(list)
+        for idx in self.sampler:
+            batch = batches[self.group_ids[idx]]
+            batch.append(idx)
+            if len(batch) == self.batch_size:
+                yield batch[:]
+                del batch[:]
+        for batch in batches.values():
+            if len(batch) > 0:
+                yield batch
 
     def __len__(self):
-        return len(self.img_paths)
+        group_sizes = Counter(self.group_ids[idx] for idx in self.sampler)
+        return sum((size + self.batch_size - 1) // self.batch_size for size in group_sizes.values())
+
+# Internal Cell
+
+def _aspect_ratio_group_ids(shapes: np.array, bins: Tuple[float, ...]=(0.5, 0.75, 1.0, 1.33, 2.0)) -> List[int]:
+    """Quantizes width/height aspect ratios of (height, width) shapes into groups"""
+    aspect_ratios = shapes[:, 1] / shapes[:, 0]
+    return np.digitize(aspect_ratios, bins).tolist()
 
 # Cell
 
@@ -299,46 +907,103 @@ def _get_instance_segmentation_dataset(
     batch_size: int = 4,
     num_workers: int = 4,
     n_samples: int=-1,
+    cache_dir: Optional[Path]=None,
+    pack_masks: bool=False,
+    storage: str="extract",
+    group_by_aspect_ratio: bool=False,
+    shared_cache_bytes: Optional[int]=None,
+    image_dtype: torch.dtype=torch.float32,
+    loading_stats: bool=False,
+    loader: str="process",
+    batch_augmentation: Optional[Callable]=None,
 ) -> Tuple[
     torch.utils.data.dataloader.DataLoader, torch.utils.data.dataloader.DataLoader
 ]:
     """Get dataset for instance segmentation. Make sure you define get_transform function."""
 
+    assert storage in ["extract", "zip"], f"storage should be either 'extract' or 'zip', but it is '{storage}'."
+    assert loader in ["process", "thread"], f"loader should be either 'process' or 'thread', but it is '{loader}'."
+
     # get data if needed
-    _download_data_if_needed()
-    root_path = Path(dataset_root)
-    assert root_path.exists()
-    assert root_path.is_dir()
-    assert len(list(root_path.glob("**/*"))) >= 600
+    _download_data_if_needed(extract=storage == "extract")
+    if storage == "zip":
+        root_path = ZipRoot(dataset_zip)
+        assert root_path.exists()
+        assert len(list(root_path.rglob("*"))) >= 600
+    else:
+        root_path = Path(dataset_root)
+        assert root_path.exists()
+        assert root_path.is_dir()
+        assert _n_extracted_files() >= 600
+
+    # decoded samples are shared by all workers of both data loaders
+    shared_store = SharedSampleStore(shared_cache_bytes) if shared_cache_bytes else None
 
     # use our dataset and defined transformations
     dataset = DolphinsInstanceSegmentationDataset(
-        dataset_root / "Train",
+        root_path / "Train",
         tensor_transforms=get_tensor_transforms(train=True),
-        n_samples=n_samples
+        n_samples=n_samples,
+        cache_dir=cache_dir,
+        pack_masks=pack_masks,
+        shared_store=shared_store,
+        image_dtype=image_dtype,
+        stats=LoadingStats(max_workers=num_workers) if loading_stats else None,
     )
     dataset_test = DolphinsInstanceSegmentationDataset(
-        dataset_root / "Val",
+        root_path / "Val",
         tensor_transforms=get_tensor_transforms(train=False),
-        n_samples=n_samples
+        n_samples=n_samples,
+        cache_dir=cache_dir,
+        pack_masks=pack_masks,
+        shared_store=shared_store,
+        image_dtype=image_dtype,
+        stats=LoadingStats(max_workers=num_workers) if loading_stats else None,
     )
 
     # define training and validation data loaders
-    data_loader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        num_workers=num_workers,
-        collate_fn=utils.collate_fn,
-    )
+    if utils.is_dist_avail_and_initialized():
+        # every rank loads its own part of both datasets, `train_one_epoch` reshuffles the parts every epoch
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=True)
+        sampler_test = torch.utils.data.distributed.DistributedSampler(dataset_test, shuffle=False)
+    else:
+        sampler = torch.utils.data.RandomSampler(dataset)
+        sampler_test = torch.utils.data.SequentialSampler(dataset_test)
+
+    loader_class = torch.utils.data.DataLoader if loader == "process" else utils.ThreadedDataLoader
+    # training batches are augmented as they are collated
+    collate_fn = batch_augmentation if batch_augmentation is not None else utils.collate_fn
+    if group_by_aspect_ratio:
+        # batches of images with similar aspect ratios need less padding
+        data_loader = loader_class(
+            dataset,
+            batch_sampler=GroupedBatchSampler(sampler, _aspect_ratio_group_ids(dataset.shapes), batch_size),
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+        )
 
-    data_loader_test = torch.utils.data.DataLoader(
-        dataset_test,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=num_workers,
-        collate_fn=utils.collate_fn,
-    )
+        data_loader_test = loader_class(
+            dataset_test,
+            batch_sampler=GroupedBatchSampler(sampler_test, _aspect_ratio_group_ids(dataset_test.shapes), batch_size),
+            num_workers=num_workers,
+            collate_fn=utils.collate_fn,
+        )
+    else:
+        data_loader = loader_class(
+            dataset,
+            batch_size=batch_size,
+            sampler=sampler,
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+        )
+
+        data_loader_test = loader_class(
+            dataset_test,
+            batch_size=batch_size,
+            sampler=sampler_test,
+            num_workers=num_workers,
+            collate_fn=utils.collate_fn,
+        )
 
     return data_loader, data_loader_test
 
@@ -385,10 +1050,38 @@ def get_dataset(
     batch_size: int = 4,
     num_workers: int = 4,
     n_samples: int=-1,
+    cache_dir: Optional[Path]=None,
+    pack_masks: bool=False,
+    storage: str="extract",
+    group_by_aspect_ratio: bool=False,
+    shared_cache_bytes: Optional[int]=None,
+    image_dtype: torch.dtype=torch.float32,
+    loading_stats: bool=False,
+    loader: str="process",
+    batch_augmentation: Optional[Callable]=None,
 ) -> Tuple[
     torch.utils.data.dataloader.DataLoader, torch.utils.data.dataloader.DataLoader
 ]:
-    """Get one of two datasets available. The parameter `name` can be one of 'segmentation' and 'classification'"""
+    """Get one of two datasets available. The parameter `name` can be one of 'segmentation' and 'classification'
+
+    If `cache_dir` is set, decoded images and annotations are stored there on first access and memory-mapped afterwards.
+    If `pack_masks` is set, target masks are bit-packed and get unpacked only when moved to the device with `to`.
+    The `storage` can be 'extract' (dataset zip is extracted once and read from disk) or 'zip' (files are read
+    directly from the dataset zip, without extracting it).
+    If `group_by_aspect_ratio` is set, every batch contains only images with similar aspect ratios, so less
+    compute is wasted on padding.
+    If `shared_cache_bytes` is set, decoded samples are kept in shared memory, up to that many bytes, and read by
+    all workers of both data loaders.
+    If `image_dtype` is `torch.uint8`, images are not scaled to [0, 1] and are four times cheaper to send from workers
+    and to the device, `train_one_epoch` scales them on the device.
+    If `loading_stats` is set, both datasets record time spent in every stage of loading in their `stats`,
+    `train_one_epoch` reports them.
+    The `loader` can be 'process' (DataLoader with worker processes) or 'thread' (`utils.ThreadedDataLoader`,
+    `num_workers` threads in the current process, using much less memory and starting instantly).
+    If a distributed process group is initialized, every rank loads only its own part of both datasets.
+    If `batch_augmentation` is given (e.g. `BatchAugmentation`), it is used as `collate_fn` of the training data loader
+    and augments whole batches at once.
+    """
 
     assert name in [
         "segmentation",
@@ -401,6 +1094,15 @@ def get_dataset(
             batch_size=batch_size,
             num_workers=num_workers,
             n_samples=n_samples,
+            cache_dir=cache_dir,
+            pack_masks=pack_masks,
+            storage=storage,
+            group_by_aspect_ratio=group_by_aspect_ratio,
+            shared_cache_bytes=shared_cache_bytes,
+            image_dtype=image_dtype,
+            loading_stats=loading_stats,
+            loader=loader,
+            batch_augmentation=batch_augmentation,
         )
     elif name == "classification":
         raise NotImplementedError()
@@ -434,8 +1136,7 @@ class CopyPasteAugmentation(object):
 
     def __init__(self, prob):
         self.prob = prob
-
-    def __call__(self, img, img_paste, masks, masks_paste, boxes, boxes_paste, labels, target):
+        # the pipeline is built once and reused for every sample
         trans =  [
             # D4 Group augmentations
             A.HueSaturationValue(p=1),
@@ -443,7 +1144,10 @@ class CopyPasteAugmentation(object):
             CopyPaste(blend=False, sigma=0, always_apply=True, pct_objects_paste=1, p=1)
         ]
         bbox_params={'format':'pascal_voc', 'min_area': 0, 'min_visibility': 0, 'label_fields': ['category_id']}
-        augs = A.Compose(trans, bbox_params=bbox_params, p=1)
+        self.augs = A.Compose(trans, bbox_params=bbox_params, p=1)
+
+    def __call__(self, img, img_paste, masks, masks_paste, boxes, boxes_paste, labels, target):
+        augs = self.augs
         boxes = [box.tolist() for box in boxes]
         boxes_paste = [box.tolist() for box in boxes_paste]
 
@@ -478,3 +1182,190 @@ class RandomHorizontalFlip(object):
                 keypoints = _flip_coco_person_keypoints(keypoints, width)
                 target["keypoints"] = keypoints
         return image, target
+
+# Internal Cell
+
+def _rgb_to_hsv(img: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Converts B x 3 x H x W RGB images in [0, 1] into B x H x W hue, saturation and value, all in [0, 1]"""
+    r, g, b = img.unbind(1)
+    value = img.amax(dim=1)
+    delta = value - img.amin(dim=1)
+    # like in OpenCV, hue is computed from the first channel equal to the maximum
+    is_r = r == value
+    is_g = (g == value) & ~is_r
+    hue = torch.where(is_r, g - b, torch.where(is_g, b - r + 2 * delta, r - g + 4 * delta))
+    hue = hue.div_(delta.clamp(min=1e-12).mul_(6)).remainder_(1)
+    saturation = delta.div_(value.clamp(min=1e-12))
+    return hue, saturation, value
+
+def _hsv_to_rgb(hue: torch.Tensor, saturation: torch.Tensor, value: torch.Tensor) -> torch.Tensor:
+    """Converts B x H x W hue, saturation and value, all in [0, 1], into B x 3 x H x W RGB images"""
+    offsets = torch.tensor([5, 3, 1], dtype=hue.dtype, device=hue.device).view(1, 3, 1, 1)
+    k = (hue.unsqueeze(1) * 6 + offsets).remainder_(6)
+    k = torch.min(k, 4 - k).clamp_(0, 1)
+    return value.unsqueeze(1) - (value * saturation).unsqueeze(1) * k
+
+def _masks_to_boxes(masks: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Boxes (xmin, ymin, xmax, ymax) of N x H x W masks, with inclusive maxima like `_extract_instances`, and
+    flags of nonempty masks"""
+    _, height, width = masks.shape
+    rows = masks.any(dim=2).to(torch.uint8)
+    cols = masks.any(dim=1).to(torch.uint8)
+    boxes = torch.stack([
+        cols.argmax(dim=1),
+        rows.argmax(dim=1),
+        width - 1 - cols.flip(1).argmax(dim=1),
+        height - 1 - rows.flip(1).argmax(dim=1),
+    ], dim=1).to(torch.float32)
+    return boxes, cols.any(dim=1).bool()
+
+# Cell
+
+class BatchAugmentation(object):
+    """ Augments whole batches of tensors instead of single samples.
+
+    Can be used as `collate_fn` of a data loader or called on already collated images and targets, e.g. after
+    they are moved to the device. Images of the same shape are stacked and augmented together, so the cost
+    grows with the number of pixels in the batch instead of the number of samples:
+
+    * every image is flipped horizontally and vertically, each with probability `flip_p`,
+    * hue, saturation and value of every image are shifted with probability `hsv_p`, by random amounts within
+      the limits given in units of uint8 images like in `A.HueSaturationValue`,
+    * with probability `copy_paste_p` every image gets `pct_objects_paste` of the objects of another image of
+      the same shape in the batch pasted over it. Objects covered completely are removed.
+
+    Boxes and areas of all objects are recomputed from the masks. Images can be uint8 or floats in [0, 1] and
+    masks can be `PackedMasks`. If `num_threads` is set, the process doing augmentation uses that many
+    intra-op threads, which matters in DataLoader workers since they use a single thread by default.
+    """
+    def __init__(
+        self,
+        flip_p: float=0.5,
+        hsv_p: float=1.0,
+        hue_shift_limit: float=20,
+        sat_shift_limit: float=30,
+        val_shift_limit: float=20,
+        copy_paste_p: float=1.0,
+        pct_objects_paste: float=1.0,
+        num_threads: Optional[int]=None,
+    ):
+        self.flip_p = flip_p
+        self.hsv_p = hsv_p
+        self.hue_shift_limit = hue_shift_limit
+        self.sat_shift_limit = sat_shift_limit
+        self.val_shift_limit = val_shift_limit
+        self.copy_paste_p = copy_paste_p
+        self.pct_objects_paste = pct_objects_paste
+        self.num_threads = num_threads
+
+    def __call__(self, batch):
+        images, targets = utils.collate_fn(batch)
+        return self.augment(images, targets)
+
+    def augment(self, images, targets):
+        """Augments collated images and targets, returns them in the same order"""
+        if self.num_threads is not None and torch.get_num_threads() != self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+        images, targets = list(images), [dict(t) for t in targets]
+        groups = defaultdict(list)
+        for i, image in enumerate(images):
+            groups[tuple(image.shape)].append(i)
+
+        for group in groups.values():
+            augmented = self._augment_group(torch.stack([images[i] for i in group]), [targets[i] for i in group])
+            for i, image, target in zip(group, *augmented):
+                images[i] = image
+                targets[i].update(target)
+
+        return tuple(images), tuple(targets)
+
+    def _shift_hsv(self, imgs: torch.Tensor) -> torch.Tensor:
+        n = imgs.shape[0]
+        shifted = (torch.rand(n) < self.hsv_p).nonzero().flatten()
+        if len(shifted) == 0:
+            return imgs
+
+        # shifts in units of uint8 images, hue is in [0, 180) in OpenCV
+        shifts = (torch.rand(len(shifted), 3) * 2 - 1) * torch.tensor(
+            [self.hue_shift_limit, self.sat_shift_limit, self.val_shift_limit], dtype=torch.float32
+        )
+
+        if imgs.dtype == torch.uint8 and imgs.device.type == "cpu":
+            # lookup tables of OpenCV are much faster than float math for uint8 images on the CPU
+            for i, (hue_shift, sat_shift, val_shift) in zip(shifted.tolist(), shifts.tolist()):
+                img = shift_hsv(imgs[i].permute(1, 2, 0).numpy().copy(), hue_shift, sat_shift, val_shift)
+                imgs[i].copy_(torch.from_numpy(img).permute(2, 0, 1))
+            return imgs
+
+        shifts = (shifts / torch.tensor([180.0, 255.0, 255.0])).to(imgs.device).view(-1, 3, 1, 1)
+        selected = imgs.index_select(0, shifted.to(imgs.device))
+        hue, saturation, value = _rgb_to_hsv(selected.float().div_(255) if imgs.dtype == torch.uint8 else selected)
+        hue = hue.add_(shifts[:, 0]).remainder_(1)
+        saturation = saturation.add_(shifts[:, 1]).clamp_(0, 1)
+        value = value.add_(shifts[:, 2]).clamp_(0, 1)
+        rgb = _hsv_to_rgb(hue, saturation, value)
+        if imgs.dtype == torch.uint8:
+            rgb = rgb.mul_(255).round_()
+        return imgs.index_copy_(0, shifted.to(imgs.device), rgb.to(imgs.dtype))
+
+    def _augment_group(self, imgs: torch.Tensor, targets: List[Dict[str, torch.Tensor]]):
+        """Augments B x C x H x W images of the same shape and their targets, all on the same device"""
+        n, _, height, width = imgs.shape
+        device = imgs.device
+
+        packed = [isinstance(t["masks"], PackedMasks) for t in targets]
+        masks = [_densify_masks(t["masks"]).to(device) for t in targets]
+        labels = [t["labels"] for t in targets]
+        iscrowd = [t["iscrowd"] for t in targets]
+
+        hflip = (torch.rand(n) < self.flip_p).tolist()
+        vflip = (torch.rand(n) < self.flip_p).tolist()
+        for i in range(n):
+            dims = [dim for dim, flip in [(-1, hflip[i]), (-2, vflip[i])] if flip]
+            if len(dims) > 0:
+                imgs[i] = imgs[i].flip(dims)
+                masks[i] = masks[i].flip(dims)
+
+        imgs = self._shift_hsv(imgs)
+
+        # every image pastes objects of the next one in a random cycle over the group
+        if n > 1:
+            order = torch.randperm(n).tolist()
+            source = dict(zip(order, order[1:] + order[:1]))
+            pasted = {}
+            for i in (torch.rand(n) < self.copy_paste_p).nonzero().flatten().tolist():
+                j = source[i]
+                chosen = torch.randperm(len(masks[j]))[:int(len(masks[j]) * self.pct_objects_paste)]
+                if len(chosen) > 0:
+                    pasted[i] = (masks[j].index_select(0, chosen.to(device)), labels[j][chosen], iscrowd[j][chosen])
+
+            sources = torch.tensor([source[i] for i in pasted], dtype=torch.int64, device=device)
+            for (i, (paste_masks, paste_labels, paste_iscrowd)), src in zip(pasted.items(), imgs.index_select(0, sources)):
+                # only the box around the pasted objects is touched
+                xmin, ymin, xmax, ymax = _masks_to_boxes(paste_masks.any(dim=0, keepdim=True))[0][0].long().tolist()
+                rows, cols = slice(ymin, ymax + 1), slice(xmin, xmax + 1)
+                alpha = paste_masks[:, rows, cols].any(dim=0).bool()
+                imgs[i, :, rows, cols] = torch.where(alpha, src[:, rows, cols], imgs[i, :, rows, cols])
+
+                n_objects = len(masks[i])
+                masks[i] = torch.cat([masks[i], paste_masks])
+                masks[i][:n_objects, rows, cols].masked_fill_(alpha, 0)
+                labels[i] = torch.cat([labels[i], paste_labels])
+                iscrowd[i] = torch.cat([iscrowd[i], paste_iscrowd])
+
+        augmented_targets = []
+        for i in range(n):
+            # objects covered completely by pasted ones are dropped
+            boxes, visible = _masks_to_boxes(masks[i])
+            if not visible.all():
+                masks[i], boxes, labels[i], iscrowd[i] = masks[i][visible], boxes[visible], labels[i][visible], iscrowd[i][visible]
+            augmented_targets.append(dict(
+                masks=PackedMasks.from_dense(masks[i].cpu()) if packed[i] else masks[i],
+                boxes=boxes,
+                labels=labels[i],
+                area=(boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0]),
+                iscrowd=iscrowd[i],
+            ))
+
+        return imgs.unbind(0), augmented_targets
@@ -1,6 +1,6 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: notebooks/02_Model.ipynb (unless otherwise specified).
 
-__all__ = ['train_one_epoch', 'show_prediction', 'show_predictions', 'iou_metric_mask_pair',
+__all__ = ['train_one_epoch', 'show_prediction', 'show_predictions', 'iou_metric_mask_pair', 'iou_metric_matrix_of_masks',
            'iou_metric_matrix_of_example', 'largest_values_in_row_colums', 'iou_metric_example', 'iou_metric',
            'show_predictions_sorted_by_iou']
 
@@ -30,7 +30,7 @@ from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
 from torchvision.transforms import ToPILImage
 
-from ..datasets import stack_imgs
+from ..datasets import stack_imgs, _as_float_image, _densify_masks
 from dolphins_recognition_challenge import utils
 
 from ..datasets import get_dataset
@@ -46,10 +46,15 @@ def train_one_epoch(
     device,
     epoch,
     print_freq=10,
+    prefetch=True,
 ):
     """ Trains one epoch of the model. Copied from the reference implementation from https://github.com/pytorch/vision.git.
+
+    If `prefetch` is set, next batches are moved to the device in the background while the current one is processed.
+    If the dataset records `LoadingStats`, they are logged per sample and summarized at the end of the epoch.
     """
     model.train()
+    utils.set_epoch(data_loader, epoch)
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
@@ -61,8 +66,15 @@ def train_one_epoch(
 
         lr_scheduler = utils.warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor)
 
+    stats = getattr(data_loader.dataset, "stats", None)
+    if stats is not None:
+        start_totals = last_totals = stats.totals()
+
+    if prefetch:
+        data_loader = utils.DevicePrefetcher(data_loader, device)
+
     for images, targets in metric_logger.log_every(data_loader, print_freq, header):
-        images = list(image.to(device) for image in images)
+        images = list(_as_float_image(image.to(device)) for image in images)
         targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
 
         loss_dict = model(images, targets)
@@ -90,6 +102,16 @@ def train_one_epoch(
         metric_logger.update(loss=losses_reduced, **loss_dict_reduced)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
+        if stats is not None:
+            totals = stats.totals()
+            metric_logger.update(**stats.per_sample(totals, last_totals))
+            last_totals = totals
+
+    if prefetch:
+        print('{} Waiting for data: {:.4f} s'.format(header, data_loader.wait_time))
+    if stats is not None:
+        print('{} Data loading: {}'.format(header, stats.summary(start_totals)))
+
     return loss_value
 
 
@@ -106,6 +128,8 @@ def show_prediction(
     """
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
+    img = _as_float_image(img)
+
     # convert Tensor to PIL Image
     img_bg = Image.fromarray(img.mul(255).permute(1, 2, 0).byte().numpy())
     images = [img_bg]
@@ -169,12 +193,12 @@ def get_true_and_predicted_masks(
     img = example[0]
 
     true_masks = (
-        example[1]["masks"].mul(255).cpu().numpy().astype(np.int8)
+        _densify_masks(example[1]["masks"]).mul(255).cpu().numpy().astype(np.int8)
     )
 
     model.eval()
     with torch.no_grad():
-        predictions = model([img.to(device)])
+        predictions = model([_as_float_image(img.to(device))])
 
     pred_scores = predictions[0]["scores"].cpu().numpy()
 
@@ -198,14 +222,14 @@ def iou_metric_mask_pair(
         IOU: IOU between the segmentation and the ground truth
     """
 
-    assert binary_segmentation.dtype in [np.int, np.int8, np.int16, np.int32, np.bool]
-    assert binary_gt_label.dtype in [np.int, np.int8, np.int16, np.int32, np.bool]
+    assert binary_segmentation.dtype in [int, np.int8, np.int16, np.int32, bool]
+    assert binary_gt_label.dtype in [int, np.int8, np.int16, np.int32, bool]
     assert len(binary_segmentation.shape) == 2
     assert len(binary_gt_label.shape) == 2
 
     # turn all variables to booleans, just in case
-    binary_segmentation = np.asarray(binary_segmentation, dtype=np.bool)
-    binary_gt_label = np.asarray(binary_gt_label, dtype=np.bool)
+    binary_segmentation = np.asarray(binary_segmentation, dtype=bool)
+    binary_gt_label = np.asarray(binary_gt_label, dtype=bool)
 
     # compute the intersection
     intersection = np.logical_and(binary_segmentation, binary_gt_label)
@@ -227,49 +251,92 @@ def iou_metric_mask_pair(
 
     return iou
 
+# Internal Cell
+
+def _matmul_intersections(xs: np.array, ys: np.array) -> np.array:
+    """Intersections of all pairs of flattened binary masks as a product of the masks. Pixels are processed in
+    chunks of at most 2^24, so float32 sums of zeros and ones are exact."""
+    n_pixels = xs.shape[1]
+    chunk = min(1 << 24, max(1 << 16, (1 << 26) // (len(xs) + len(ys))))
+    intersections = np.zeros((len(xs), len(ys)), dtype=np.int64)
+    for start in range(0, n_pixels, chunk):
+        x = xs[:, start:start + chunk].astype(np.float32)
+        y = ys[:, start:start + chunk].astype(np.float32)
+        intersections += np.rint(x @ y.T).astype(np.int64)
+    return intersections
+
+def _mask_boxes(masks: np.array) -> np.array:
+    """Boxes (ymin, xmin, ymax, xmax) of N x H x W binary masks with exclusive maxima, empty for empty masks"""
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    height, width = masks.shape[1:]
+    boxes = np.column_stack([
+        rows.argmax(axis=1),
+        cols.argmax(axis=1),
+        height - rows[:, ::-1].argmax(axis=1),
+        width - cols[:, ::-1].argmax(axis=1),
+    ])
+    boxes[~rows.any(axis=1)] = 0
+    return boxes
+
+def _pruned_intersections(xs: np.array, ys: np.array) -> np.array:
+    """Intersections of all pairs of N x H x W binary masks, counted only within overlaps of their boxes"""
+    boxes_x, boxes_y = _mask_boxes(xs), _mask_boxes(ys)
+    top_left = np.maximum(boxes_x[:, None, :2], boxes_y[None, :, :2])
+    bottom_right = np.minimum(boxes_x[:, None, 2:], boxes_y[None, :, 2:])
+    intersections = np.zeros((len(xs), len(ys)), dtype=np.int64)
+    for j, i in zip(*np.nonzero((bottom_right > top_left).all(axis=2))):
+        (y0, x0), (y1, x1) = top_left[j, i], bottom_right[j, i]
+        intersections[j, i] = np.count_nonzero(xs[j, y0:y1, x0:x1] & ys[i, y0:y1, x0:x1])
+    return intersections
+
+# Cell
+
+def iou_metric_matrix_of_masks(
+    predicted: np.array,
+    true: np.array,
+    prune_boxes: bool = False,
+) -> np.array:
+    """ Computes IOU of every predicted mask (rows) with every true mask (columns), exactly the same as
+    `iou_metric_mask_pair` does it for every pair.
+
+    Intersections of all pairs are computed at once as a product of the flattened masks, unions follow from areas
+    of the masks. If `prune_boxes` is set, intersections are counted only for pairs with overlapping boxes, within
+    the overlap, which is faster when there are many masks that mostly do not overlap.
+    """
+    n_predicted, n_true = len(predicted), len(true)
+    if n_predicted == 0:
+        return np.array([])
+    if n_true == 0:
+        return np.zeros((n_predicted, 0))
+
+    # every nonzero pixel belongs to the mask
+    predicted = np.asarray(predicted) != 0
+    true = np.asarray(true) != 0
+    predicted_areas = predicted.reshape(n_predicted, -1).sum(axis=1)
+    true_areas = true.reshape(n_true, -1).sum(axis=1)
+
+    if prune_boxes:
+        intersections = _pruned_intersections(predicted, true)
+    else:
+        intersections = _matmul_intersections(predicted.reshape(n_predicted, -1), true.reshape(n_true, -1))
+    unions = predicted_areas[:, None] + true_areas[None, :] - intersections
+
+    smooth = 0.001
+    return (intersections + smooth) / (unions + smooth)
+
 # Cell
 
 
 def iou_metric_matrix_of_example(
     model: torchvision.models.detection.mask_rcnn.MaskRCNN,
     example: Tuple[torch.Tensor, Dict[str, torch.Tensor]],
-    score_threshold: float = 0.5
+    score_threshold: float = 0.5,
+    prune_boxes: bool = False,
 ) -> List[List[float]]:
     _, masks = get_true_and_predicted_masks(model, example, score_threshold)
 
-    return np.array(
-        [
-            [
-                iou_metric_mask_pair(
-                    binary_segmentation=masks["predicted"][j, :, :],
-                    binary_gt_label=masks["true"][i, :, :],
-                )
-                for i in range(masks["true"].shape[0])
-            ]
-            for j in range(masks["predicted"].shape[0])
-        ]
-    )
-
-# Internal Cell
-
-def _argmax2d(xs: np.array) -> Tuple[int, int]:
-    assert len(xs.shape) == 2
-
-    n_col = xs.shape[1]
-    ij = xs.argmax()
-    i = ij // n_col
-    j = ij % n_col
-    return i, j
-
-def _drop_max_row_and_column(xs: np.array) -> Tuple[float, np.array]:
-    i, j = _argmax2d(xs)
-
-    max_value = xs[i, j]
-
-    xs = np.delete(xs, i, 0)
-    xs = np.delete(xs, j, 1)
-
-    return max_value, xs
+    return iou_metric_matrix_of_masks(masks["predicted"], masks["true"], prune_boxes=prune_boxes)
 
 # Internal Cell
 
@@ -279,10 +346,39 @@ def _resize_to_square(xs: np.array) -> np.array:
     new_xs[:xs.shape[0], :xs.shape[1]] = xs
     return new_xs
 
+# Internal Cell
+
+def _greedy_matching(xs: np.array) -> Tuple[np.array, np.array]:
+    """Rows and columns of the largest value, then of the largest value in the remaining rows and columns, etc."""
+    n = xs.shape[0]
+    # stable sort keeps ties in the row-major order, the same as argmax does
+    order = np.argsort(-xs, axis=None, kind="stable")
+    used_rows = np.zeros(n, dtype=bool)
+    used_cols = np.zeros(n, dtype=bool)
+    rows, cols = [], []
+    for i, j in zip(*np.unravel_index(order, xs.shape)):
+        if used_rows[i] or used_cols[j]:
+            continue
+        used_rows[i] = used_cols[j] = True
+        rows.append(i)
+        cols.append(j)
+        if len(rows) == n:
+            break
+    return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+def _optimal_matching(xs: np.array) -> Tuple[np.array, np.array]:
+    """Rows and columns of values with the largest sum, one in every row and column"""
+    from scipy.optimize import linear_sum_assignment
+
+    return linear_sum_assignment(xs, maximize=True)
+
 # Cell
 
-def largest_values_in_row_colums(xs: np.array) -> List[float]:
+def largest_values_in_row_colums(xs: np.array, optimal: bool = False) -> List[float]:
     """ Approximates the largest value in each row/column.
+
+    Values are matched greedily: the largest value in the matrix first, then the largest one in the remaining rows
+    and columns, etc. If `optimal` is set, values are matched so that their sum is the largest (requires scipy).
     """
     if xs.shape == (0, ):
         return [0]
@@ -295,14 +391,8 @@ def largest_values_in_row_colums(xs: np.array) -> List[float]:
 
     assert xs.shape[0] == xs.shape[1]
 
-
-    # return the only value if a single value in the matrix
-    if xs.shape[0] == 1:
-        return [xs[0, 0]]
-
-    # find the largest value in the matirx and recursively find the largest values in the remaining matrix
-    max_value, remainder = _drop_max_row_and_column(xs)
-    return [max_value] + largest_values_in_row_colums(remainder)
+    rows, cols = _optimal_matching(xs) if optimal else _greedy_matching(xs)
+    return list(xs[rows, cols])
 
 # Cell
 
@@ -311,10 +401,11 @@ def iou_metric_example(
     model: torchvision.models.detection.mask_rcnn.MaskRCNN,
     example: Tuple[torch.Tensor, Dict[str, torch.Tensor]],
     score_threshold: float = 0.5,
+    optimal: bool = False,
 ) -> float:
 
     iou_matrix = iou_metric_matrix_of_example(model, example, score_threshold)
-    matching_ious = largest_values_in_row_colums(iou_matrix)
+    matching_ious = largest_values_in_row_colums(iou_matrix, optimal=optimal)
     iou = np.mean(matching_ious)
 
     return iou
@@ -327,12 +418,20 @@ def iou_metric(
     dataset: torch.utils.data.Dataset,
     score_threshold: float = 0.5,
 ) -> float:
-    """Calculate IOU metric on the whole dataloader"""
+    """Calculate IOU metric on the whole dataloader
+
+    If a distributed process group is initialized, every rank evaluates its own share of examples and
+    all ranks return results for the whole dataset.
+    """
+
+    # every rank evaluates every world_size-th example
+    indices = range(utils.get_rank(), len(dataset), utils.get_world_size())
+    iou = {i: iou_metric_example(model, dataset[i], score_threshold) for i in indices}
 
-    iou = [
-        iou_metric_example(model, dataset[i], score_threshold)
-        for i in range(len(dataset))
-    ]
+    gathered = {}
+    for part in utils.all_gather(iou):
+        gathered.update(part)
+    iou = [gathered[i] for i in range(len(dataset))]
 
     img_paths = [f for f in dataset.img_paths]
 
@@ -0,0 +1,243 @@
+"""Caches of decoded dataset samples, so that images and annotations are decoded only once."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+from pathlib import Path
+from typing import *
+
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    # python < 3.8, SharedSampleStore is not available
+    SharedMemory = None
+
+# bump whenever the decoded representation of a sample changes
+_CACHE_VERSION = 2
+
+# arrays stored for each sample, in the order returned by `get`
+SAMPLE_FIELDS = ("image", "instances", "obj_ids", "boxes", "labels")
+
+# large arrays are memory-mapped, small ones are read into memory
+_MMAP_FIELDS = ("image", "instances")
+
+
+def sample_key(paths: Iterable[Path], extra: Any = None) -> str:
+    """Returns a key identifying a sample by its source files (path, mtime and size) and `extra` parameters
+
+    Paths can be anything with `stat` and `resolve` methods, e.g. members of a zip archive.
+    """
+    h = hashlib.sha1(f"v{_CACHE_VERSION}".encode())
+    for path in paths:
+        st = path.stat()
+        h.update(f"{path.resolve()}:{st.st_mtime_ns}:{st.st_size};".encode())
+    h.update(repr(extra).encode())
+    return h.hexdigest()
+
+
+class DiskSampleCache(object):
+    """Persistent on-disk cache of decoded samples stored as `.npy` files.
+
+    Every sample is stored in its own directory named by its key. Large arrays are
+    memory-mapped when read, so cached samples are read without decoding or copying.
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, ...]]:
+        """Returns cached arrays for the key or `None` if the sample is not cached"""
+        d = self.cache_dir / key
+        if not d.exists():
+            return None
+        try:
+            return tuple(
+                np.load(d / f"{field}.npy", mmap_mode="r" if field in _MMAP_FIELDS else None)
+                for field in SAMPLE_FIELDS
+            )
+        except (OSError, ValueError):
+            # partially written or corrupted entry
+            return None
+
+    def put(self, key: str, arrays: Sequence[np.ndarray]) -> None:
+        """Stores arrays under the key. Concurrent writers of the same key are safe, the first one wins."""
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir))
+        try:
+            for field, xs in zip(SAMPLE_FIELDS, arrays):
+                np.save(tmp_dir / f"{field}.npy", np.ascontiguousarray(xs))
+            os.rename(tmp_dir, self.cache_dir / key)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class _SharedStoreIndex(object):
+    """LRU index of shared memory segments holding samples. It lives in a manager process, which owns all the segments."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # key -> [segment name, size in bytes, layout of arrays or None while the segment is being written]
+        self.entries = OrderedDict()
+        self.segments = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: str) -> Optional[Tuple[str, List[Tuple[Tuple[int, ...], str, int]]]]:
+        entry = self.entries.get(key)
+        if entry is None or entry[2] is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0], entry[2]
+
+    def reserve(self, key: str, nbytes: int) -> Optional[str]:
+        """Creates a segment for the key, evicting least recently used ones if needed. Returns `None` if the key
+        is already stored or the sample does not fit into the budget."""
+        if key in self.entries or nbytes > self.max_bytes:
+            return None
+        while self.nbytes + nbytes > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+
+        shm = SharedMemory(create=True, size=max(nbytes, 1))
+        self.segments[shm.name] = shm
+        self.entries[key] = [shm.name, nbytes, None]
+        self.nbytes += nbytes
+        return shm.name
+
+    def commit(self, key: str, layout: List[Tuple[Tuple[int, ...], str, int]]) -> None:
+        """Makes the written segment visible to readers"""
+        if key in self.entries:
+            self.entries[key][2] = layout
+
+    def _evict(self, key: str) -> None:
+        name, nbytes, _ = self.entries.pop(key)
+        shm = self.segments.pop(name)
+        shm.close()
+        shm.unlink()
+        self.nbytes -= nbytes
+
+    def stats(self) -> Dict[str, int]:
+        return dict(n_samples=len(self.entries), nbytes=self.nbytes, hits=self.hits, misses=self.misses)
+
+    def close(self) -> None:
+        for key in list(self.entries):
+            self._evict(key)
+
+
+class _SharedStoreManager(BaseManager):
+    pass
+
+
+_SharedStoreManager.register("_SharedStoreIndex", _SharedStoreIndex)
+
+
+def _close_shared_store(manager: _SharedStoreManager, index: _SharedStoreIndex) -> None:
+    try:
+        index.close()
+    finally:
+        manager.shutdown()
+
+
+class SharedSampleStore(object):
+    """Cache of decoded samples in shared memory, shared by all processes using it.
+
+    Every sample is stored once, in its own shared memory segment, no matter how many DataLoader workers or datasets
+    read it. Least recently used samples are evicted when the total size would exceed `max_bytes`. Arrays are copied
+    out of the segment on `get`, so segments can be evicted at any time without affecting readers.
+    """
+
+    def __init__(self, max_bytes: int):
+        assert SharedMemory is not None, "SharedSampleStore requires Python 3.8 or newer"
+        # start the resource tracker before any worker is forked, otherwise every worker starts its own tracker
+        # which unlinks all segments the worker attached to when the worker exits
+        resource_tracker.ensure_running()
+        self._manager = _SharedStoreManager()
+        self._manager.start()
+        self._index = self._manager._SharedStoreIndex(max_bytes)
+        self._finalizer = weakref.finalize(self, _close_shared_store, self._manager, self._index)
+
+    def __getstate__(self):
+        # workers only need the proxy of the index
+        return {"_index": self._index}
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, ...]]:
+        """Returns stored arrays for the key or `None` if the sample is not stored"""
+        found = self._index.lookup(key)
+        if found is None:
+            return None
+        name, layout = found
+        try:
+            shm = SharedMemory(name=name)
+        except FileNotFoundError:
+            # evicted in the meantime
+            return None
+        try:
+            return tuple(
+                np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset).copy()
+                for shape, dtype, offset in layout
+            )
+        finally:
+            shm.close()
+
+    def put(self, key: str, arrays: Sequence[np.ndarray]) -> None:
+        """Stores arrays under the key, unless they are already stored or do not fit into the budget"""
+        arrays = [np.ascontiguousarray(xs) for xs in arrays]
+        layout = []
+        nbytes = 0
+        for xs in arrays:
+            # align arrays to cache lines
+            nbytes = (nbytes + 63) // 64 * 64
+            layout.append((xs.shape, xs.dtype.str, nbytes))
+            nbytes += xs.nbytes
+
+        name = self._index.reserve(key, nbytes)
+        if name is None:
+            return
+        try:
+            shm = SharedMemory(name=name)
+        except FileNotFoundError:
+            return
+        try:
+            for xs, (shape, dtype, offset) in zip(arrays, layout):
+                np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = xs
+        finally:
+            shm.close()
+        self._index.commit(key, layout)
+
+    def stats(self) -> Dict[str, int]:
+        """Number of stored samples, their total size in bytes and number of lookup hits and misses"""
+        return self._index.stats()
+
+    def close(self) -> None:
+        """Frees all shared memory, can only be called by the process that created the store"""
+        self._finalizer()
+
+
+class TieredSampleCache(object):
+    """Looks samples up in a sequence of caches, fastest first. Samples found in a slower cache or decoded anew
+    are stored in all faster caches."""
+
+    def __init__(self, caches: Sequence[Any]):
+        self.caches = list(caches)
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, ...]]:
+        for i, cache in enumerate(self.caches):
+            arrays = cache.get(key)
+            if arrays is not None:
+                for faster_cache in self.caches[:i]:
+                    faster_cache.put(key, arrays)
+                return arrays
+        return None
+
+    def put(self, key: str, arrays: Sequence[np.ndarray]) -> None:
+        for cache in self.caches:
+            cache.put(key, arrays)
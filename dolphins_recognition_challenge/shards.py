@@ -0,0 +1,304 @@
+"""Sharded tar format of the dataset, streamed sequentially instead of opening every file of every sample."""
+
+__all__ = ['export_shards', 'ShardedInstanceSegmentationDataset', 'export_dataset_shards']
+
+from pathlib import Path
+from typing import *
+
+import io
+import itertools
+import json
+import os
+import random
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+import torch.utils.data
+from fastcore.script import *
+
+from dolphins_recognition_challenge import utils
+from dolphins_recognition_challenge.datasets import (
+    LoadingStats,
+    _decode_sample,
+    _load_or_build_manifest,
+    _load_or_enumerate_class_colors,
+    _make_example,
+    _needs_paste_partner,
+    _resize_paste_partner,
+    _sample_from_decoded,
+    _timer,
+)
+from dolphins_recognition_challenge.zip_reader import ZipRoot
+
+# index of shards and their number of samples, stored next to the shards
+_shards_index_fname = "index.json"
+
+
+def _encode_sample(item) -> Tuple[str, Dict[str, bytes]]:
+    """Encodes a sample into the files stored in a shard: the original JPEG, a PNG with instance ids and
+    a JSON with boxes and labels"""
+    idx, stem, (img_path, label_path, mask_path), class_colors = item
+    img, mask, obj_ids, boxes, labels = _decode_sample(idx, img_path, label_path, mask_path, class_colors)
+    ok, png = cv2.imencode(".png", mask)
+    assert ok, f"could not encode instances of {mask_path}"
+    meta = dict(
+        idx=idx,
+        stem=stem,
+        shape=list(img.shape[:2]),
+        obj_ids=obj_ids.tolist(),
+        boxes=boxes.tolist(),
+        labels=labels.tolist(),
+    )
+    return f"{idx:08d}", {"jpg": img_path.read_bytes(), "png": png.tobytes(), "json": json.dumps(meta).encode()}
+
+
+class _ShardWriter(object):
+    """Writes samples into tar shards of at most `shard_bytes` each (a single larger sample gets its own shard)"""
+
+    def __init__(self, out_dir: Path, shard_bytes: int):
+        self.out_dir = out_dir
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self._tar = None
+        self._nbytes = 0
+
+    def write(self, key: str, files: Dict[str, bytes]) -> None:
+        # tar adds a 512 byte header to every file and pads its data to 512 bytes
+        nbytes = sum(512 + (len(data) + 511) // 512 * 512 for data in files.values())
+        if self._tar is None or (self._nbytes + nbytes > self.shard_bytes and self.shards[-1][1] > 0):
+            self._open_next()
+        for ext, data in files.items():
+            info = tarfile.TarInfo(f"{key}.{ext}")
+            info.size = len(data)
+            self._tar.addfile(info, io.BytesIO(data))
+        self._nbytes += nbytes
+        self.shards[-1][1] += 1
+
+    def _open_next(self) -> None:
+        self.close()
+        name = f"shard-{len(self.shards):06d}.tar"
+        self._tar = tarfile.open(self.out_dir / name, "w")
+        self._nbytes = 0
+        self.shards.append([name, 0])
+
+    def close(self) -> None:
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+
+def export_shards(
+    root: Union[Path, ZipRoot],
+    out_dir: Path,
+    *,
+    shard_bytes: int = 256 * 2 ** 20,
+    n_samples: int = -1,
+    max_workers: Optional[int] = None,
+) -> List[Tuple[str, int]]:
+    """Packs a dataset directory (`JPEGImages`, `SegmentationClass`, `SegmentationObject`) into tar shards.
+
+    Every sample is stored as three consecutive files: the original JPEG, a PNG with instance ids and a JSON
+    with boxes and labels. Returns names of the shards and their number of samples.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = _load_or_build_manifest(root)
+    # negative `n_samples` selects all samples
+    selected = slice(n_samples if n_samples >= 0 else None)
+    stems = manifest["stems"][selected]
+    paths = [
+        (root / "JPEGImages" / str(img), root / "SegmentationClass" / str(label), root / "SegmentationObject" / str(mask))
+        for img, label, mask in zip(
+            manifest["img_names"][selected], manifest["label_names"][selected], manifest["mask_names"][selected]
+        )
+    ]
+    class_colors = _load_or_enumerate_class_colors(root, [label_path for _, label_path, _ in paths])
+    items = [(idx, str(stem), sample_paths, class_colors) for idx, (stem, sample_paths) in enumerate(zip(stems, paths))]
+
+    writer = _ShardWriter(out_dir, shard_bytes)
+    try:
+        if max_workers == 1:
+            for key, files in map(_encode_sample, items):
+                writer.write(key, files)
+        else:
+            # samples are encoded in parallel and written in order
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                for key, files in executor.map(_encode_sample, items, chunksize=8):
+                    writer.write(key, files)
+    finally:
+        writer.close()
+
+    index = {"class_colors": [list(x) for x in class_colors], "shards": writer.shards}
+    (out_dir / _shards_index_fname).write_text(json.dumps(index))
+
+    return writer.shards
+
+
+def _shard_sample_shape(files: Dict[str, bytes]) -> Tuple[int, int]:
+    """Reads (height, width) of a sample read from a shard without decoding its pixels"""
+    height, width = json.loads(files["json"])["shape"]
+    return height, width
+
+
+def _decode_shard_sample(files: Dict[str, bytes]):
+    """Decodes files of a sample read from a shard into (img, boxes, masks, labels, image_id, area, iscrowd)"""
+    meta = json.loads(files["json"])
+    img = cv2.imdecode(np.frombuffer(files["jpg"], dtype=np.uint8), 1)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    mask = cv2.imdecode(np.frombuffer(files["png"], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    obj_ids = np.array(meta["obj_ids"], dtype=mask.dtype)
+    boxes = np.array(meta["boxes"], dtype=np.float32).reshape(-1, 6)
+    labels = np.array(meta["labels"], dtype=np.int64)
+    return _sample_from_decoded(meta["idx"], (img, mask, obj_ids, boxes, labels))
+
+
+def _iter_shard(path: Path) -> Iterator[Dict[str, bytes]]:
+    """Reads a shard sequentially and yields files of one sample at a time, by extension"""
+    files, key = {}, None
+    with tarfile.open(path, "r|") as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            sample_key, ext = info.name.split(".", 1)
+            if sample_key != key and len(files) > 0:
+                yield files
+                files = {}
+            key = sample_key
+            files[ext] = tar.extractfile(info).read()
+    if len(files) > 0:
+        yield files
+
+
+class ShardedInstanceSegmentationDataset(torch.utils.data.IterableDataset):
+    """Instance segmentation dataset streamed from tar shards written by `export_shards`.
+
+    Shards are split between distributed ranks and then between DataLoader workers, so every sample is read
+    by one worker only; there should be at least as many shards as ranks times workers. Every worker of every
+    rank yields as many samples as the same worker of the rank with the fewest samples, the rest of the epoch
+    is dropped, so that all ranks take the same number of steps. If `shuffle` is set, the order of shards is
+    shuffled every epoch (call `set_epoch` before every epoch) and samples are shuffled within a buffer of
+    `shuffle_buffer` samples. The buffer keeps samples as they are stored in the shard and they are decoded
+    only when they are yielded. Copy-paste partners are sampled among samples in the buffer of the same shape,
+    `paste_fallback` decides what happens if there are none, like in `DolphinsInstanceSegmentationDataset`.
+    """
+
+    def __init__(
+        self,
+        shards_dir: Path,
+        tensor_transforms: Optional[Callable] = None,
+        shuffle: bool = True,
+        shuffle_buffer: int = 256,
+        seed: int = 0,
+        paste_fallback: str = "resize",
+        pack_masks: bool = False,
+        image_dtype: torch.dtype = torch.float32,
+        stats: Optional[LoadingStats] = None,
+    ):
+        assert paste_fallback in ["resize", "skip"], f"paste_fallback should be either 'resize' or 'skip', but it is '{paste_fallback}'."
+
+        self.shards_dir = Path(shards_dir)
+        index = json.loads((self.shards_dir / _shards_index_fname).read_text())
+        self.shards = [(name, n) for name, n in index["shards"]]
+        self.tensor_transforms = tensor_transforms
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.paste_fallback = paste_fallback
+        self.pack_masks = pack_masks
+        self.image_dtype = image_dtype
+        self.stats = stats
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _ranks_shards(self) -> List[List[Tuple[str, int]]]:
+        """Shards of every rank, in the order of the current epoch"""
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        world_size = utils.get_world_size()
+        return [shards[rank::world_size] for rank in range(world_size)]
+
+    def _rank_shards(self) -> List[Tuple[str, int]]:
+        """Shards of the current rank, in the order of the current epoch"""
+        return self._ranks_shards()[utils.get_rank()]
+
+    def __len__(self):
+        # exact without DataLoader workers, an upper bound with them since every worker is balanced on its own
+        return min(sum(n for _, n in shards) for shards in self._ranks_shards())
+
+    def _get_paste_partner(self, sample, buffer, rng):
+        img, boxes, masks, *_ = sample
+        candidates = [files for shape, files in buffer if shape == img.shape[:2]]
+        if len(candidates) == 0 and self.paste_fallback == "resize":
+            candidates = [files for _, files in buffer]
+            if self.stats is not None:
+                self.stats.add("partner_fallbacks")
+        if len(candidates) == 0:
+            if self.stats is not None:
+                self.stats.add("partner_fallbacks")
+            return img, boxes[:0], masks[:0]
+
+        with _timer(self.stats, "decode_ms"):
+            img_b, boxes_b, masks_b, *_ = _decode_shard_sample(rng.choice(candidates))
+        if img_b.shape != img.shape:
+            img_b, boxes_b, masks_b = _resize_paste_partner(img_b, boxes_b, masks_b, img.shape[:2])
+        return img_b, boxes_b, masks_b
+
+    def _samples(self, shards: List[Tuple[str, int]]):
+        """Samples of the shards as they are stored, with their (height, width)"""
+        for name, _ in shards:
+            for files in _iter_shard(self.shards_dir / name):
+                yield _shard_sample_shape(files), files
+
+    def __iter__(self):
+        ranks_shards = self._ranks_shards()
+        info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        shards = ranks_shards[utils.get_rank()][worker_id::num_workers]
+        # the same worker of every rank yields the same number of samples, so ranks do not wait for each other
+        n_samples = min(sum(n for _, n in rank_shards[worker_id::num_workers]) for rank_shards in ranks_shards)
+
+        rng = random.Random((self.seed + self.epoch) * 1000003 + utils.get_rank() * 1009 + worker_id)
+        buffer_size = self.shuffle_buffer if self.shuffle else 1
+        buffer = []
+        samples = itertools.islice(self._samples(shards), n_samples)
+        while True:
+            # fill the buffer, then yield a random sample from it
+            for sample in samples:
+                buffer.append(sample)
+                if len(buffer) >= buffer_size:
+                    break
+            if len(buffer) == 0:
+                return
+            i = rng.randrange(len(buffer)) if self.shuffle else 0
+            _, files = buffer.pop(i)
+            with _timer(self.stats, "decode_ms"):
+                sample = _decode_shard_sample(files)
+
+            partner = None
+            if _needs_paste_partner(self.tensor_transforms):
+                with _timer(self.stats, "partner_ms"):
+                    partner = self._get_paste_partner(sample, buffer, rng)
+
+            yield _make_example(sample, partner, self.tensor_transforms, self.pack_masks, self.image_dtype, self.stats)
+
+
+@call_parse
+def export_dataset_shards(
+    src_path: Param("input directory containing JPEGImages, SegmentationClass and SegmentationObject", Path),
+    dst_path: Param("output directory for the shards", Path),
+    shard_mb: Param("maximal size of a shard in MB", int) = 256,
+    n_samples: Param("number of samples to export, all by default", int) = -1,
+    max_workers: Param("number of processes encoding samples, number of CPUs by default", int) = None,
+):
+    """Packs the dataset into tar shards for streaming with `ShardedInstanceSegmentationDataset`"""
+    shards = export_shards(
+        src_path, dst_path, shard_bytes=shard_mb * 2 ** 20, n_samples=n_samples, max_workers=max_workers
+    )
+    print(f"Exported {sum(n for _, n in shards)} samples into {len(shards)} shards in: {Path(dst_path).resolve()}")
@@ -0,0 +1,300 @@
+"""Bank of annotated instances cut out of the dataset, pasted into images without loading a second sample."""
+
+__all__ = ['build_sprite_bank', 'SpriteBank', 'SpriteCopyPaste', 'build_dataset_sprite_bank']
+
+from pathlib import Path
+from typing import *
+
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import albumentations as A
+import cv2
+import numpy as np
+from fastcore.script import *
+
+from dolphins_recognition_challenge.copy_paste import extract_bboxes, image_copy_paste, occlude_masks
+from dolphins_recognition_challenge.datasets import (
+    _decode_sample,
+    _load_or_build_manifest,
+    _load_or_enumerate_class_colors,
+)
+from dolphins_recognition_challenge.zip_reader import ZipRoot
+
+# RGBA pixels of all sprites, one after another
+_sprites_fname = "sprites.bin"
+
+# position of every sprite in the pixels, its box in the source image and its class
+_index_fname = "index.npy"
+
+_index_dtype = np.dtype([
+    ("offset", np.int64),
+    ("height", np.int32),
+    ("width", np.int32),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("label", np.int32),
+    ("image_height", np.int32),
+    ("image_width", np.int32),
+    ("sample", np.int32),
+])
+
+
+def _cut_sprites(item) -> Tuple[List[np.array], List[Tuple[int, ...]]]:
+    """Cuts all instances of a sample into RGBA sprites cropped to their boxes"""
+    idx, (img_path, label_path, mask_path), class_colors = item
+    img, mask, obj_ids, boxes, labels = _decode_sample(idx, img_path, label_path, mask_path, class_colors)
+    height, width = img.shape[:2]
+
+    sprites, rows = [], []
+    for (xmin, ymin, xmax, ymax, _, i), label in zip(boxes.astype(np.int64), labels):
+        crop = (slice(ymin, ymax + 1), slice(xmin, xmax + 1))
+        sprite = np.empty((ymax + 1 - ymin, xmax + 1 - xmin, 4), dtype=np.uint8)
+        sprite[..., :3] = img[crop]
+        sprite[..., 3] = mask[crop] == obj_ids[i]
+        sprites.append(sprite)
+        rows.append((sprite.shape[0], sprite.shape[1], xmin, ymin, label, height, width, idx))
+    return sprites, rows
+
+
+def build_sprite_bank(
+    root: Union[Path, ZipRoot],
+    out_dir: Path,
+    *,
+    n_samples: int = -1,
+    max_workers: Optional[int] = None,
+) -> int:
+    """Cuts every annotated instance of the dataset into an RGBA sprite cropped to its box and stores them all
+    in `out_dir` for `SpriteBank`. Returns the number of sprites."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = _load_or_build_manifest(root)
+    # negative `n_samples` selects all samples
+    selected = slice(n_samples if n_samples >= 0 else None)
+    paths = [
+        (root / "JPEGImages" / str(img), root / "SegmentationClass" / str(label), root / "SegmentationObject" / str(mask))
+        for img, label, mask in zip(
+            manifest["img_names"][selected], manifest["label_names"][selected], manifest["mask_names"][selected]
+        )
+    ]
+    class_colors = _load_or_enumerate_class_colors(root, [label_path for _, label_path, _ in paths])
+    items = [(idx, sample_paths, class_colors) for idx, sample_paths in enumerate(paths)]
+
+    index = []
+    offset = 0
+    with open(out_dir / _sprites_fname, "wb") as f:
+        if max_workers == 1:
+            cut = map(_cut_sprites, items)
+        else:
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+            cut = executor.map(_cut_sprites, items, chunksize=8)
+        try:
+            for sprites, rows in cut:
+                for sprite, row in zip(sprites, rows):
+                    f.write(sprite.tobytes())
+                    index.append((offset,) + tuple(row))
+                    offset += sprite.nbytes
+        finally:
+            if max_workers != 1:
+                executor.shutdown()
+
+    np.save(out_dir / _index_fname, np.array(index, dtype=_index_dtype))
+
+    return len(index)
+
+
+class SpriteBank(object):
+    """ Sprites written by `build_sprite_bank`. Pixels are memory-mapped, so reading a sprite costs only the
+    pages it occupies.
+    """
+    def __init__(self, bank_dir: Path):
+        self.bank_dir = Path(bank_dir)
+        self.index = np.load(self.bank_dir / _index_fname)
+        self._pixels = None
+
+    def __getstate__(self):
+        # every process maps the pixels on its own
+        state = self.__dict__.copy()
+        state["_pixels"] = None
+        return state
+
+    @property
+    def pixels(self) -> np.array:
+        if self._pixels is None:
+            self._pixels = np.memmap(self.bank_dir / _sprites_fname, dtype=np.uint8, mode="r")
+        return self._pixels
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> np.array:
+        """Returns an H x W x 4 RGBA sprite"""
+        row = self.index[i]
+        nbytes = int(row["height"]) * int(row["width"]) * 4
+        offset = int(row["offset"])
+        return self.pixels[offset:offset + nbytes].reshape(int(row["height"]), int(row["width"]), 4)
+
+
+class SpriteCopyPaste(A.DualTransform):
+    """ Pastes random sprites from a `SpriteBank` into the image.
+
+    Unlike `CopyPaste`, no second sample is needed, so the dataset does not load one. Between `n_objects[0]` and
+    `n_objects[1]` sprites are pasted either at random positions or, with `placement='original'`, at their
+    positions in the source image scaled to the shape of the image. Sprites larger than the image are scaled
+    down to fit. Pasted pixels are removed from the existing masks and boxes are recomputed, objects covered
+    completely are removed together with their boxes.
+
+    Bboxes are expected as (x_min, y_min, x_max, y_max, score, mask index, *labels), like in
+    `DolphinsInstanceSegmentationDataset`, where `n_labels` is the number of label fields of the bbox params.
+    """
+    def __init__(
+        self,
+        bank: Union[Path, SpriteBank],
+        n_objects: Tuple[int, int] = (1, 3),
+        placement: str = "random",
+        blend: bool = True,
+        sigma: float = 3,
+        n_labels: int = 1,
+        p: float = 0.5,
+        always_apply: bool = False,
+    ):
+        super(SpriteCopyPaste, self).__init__(always_apply, p)
+        assert placement in ["random", "original"], f"placement should be either 'random' or 'original', but it is '{placement}'."
+        self.bank = bank if isinstance(bank, SpriteBank) else SpriteBank(bank)
+        self.n_objects = n_objects
+        self.placement = placement
+        self.blend = blend
+        self.sigma = sigma
+        self.n_labels = n_labels
+
+    @staticmethod
+    def get_class_fullname():
+        return 'copypaste.SpriteCopyPaste'
+
+    @property
+    def targets_as_params(self):
+        return ["image", "masks"]
+
+    def _place(self, i: int, height: int, width: int) -> Tuple[np.array, int, int, int]:
+        """Returns the sprite `i` resized to fit the image, its top-left corner and its label"""
+        sprite = self.bank[i]
+        row = self.bank.index[i]
+        scale = 1.0
+        if self.placement == "original":
+            scale = min(height / row["image_height"], width / row["image_width"])
+        scale = min(scale, height / sprite.shape[0], width / sprite.shape[1])
+        if scale != 1.0:
+            size = (max(int(sprite.shape[1] * scale), 1), max(int(sprite.shape[0] * scale), 1))
+            sprite = cv2.resize(np.asarray(sprite), size, interpolation=cv2.INTER_NEAREST)
+
+        h, w = sprite.shape[:2]
+        if self.placement == "original":
+            y = min(int(row["y"] * scale), height - h)
+            x = min(int(row["x"] * scale), width - w)
+        else:
+            y = random.randint(0, height - h)
+            x = random.randint(0, width - w)
+        return sprite, y, x, int(row["label"])
+
+    def get_params_dependent_on_targets(self, params):
+        height, width = params["image"].shape[:2]
+        n = random.randint(*self.n_objects) if len(self.bank) > 0 else 0
+        placed = [self._place(random.randrange(len(self.bank)), height, width) for _ in range(n)]
+
+        # later sprites are pasted over earlier ones
+        alpha = np.zeros((height, width), dtype=bool)
+        paste_masks = np.zeros((len(placed), height, width), dtype=np.uint8)
+        for j, (sprite, y, x, _) in enumerate(placed):
+            roi = (slice(y, y + sprite.shape[0]), slice(x, x + sprite.shape[1]))
+            sprite_alpha = sprite[..., 3] != 0
+            paste_masks[:j, roi[0], roi[1]] &= ~sprite_alpha
+            paste_masks[j][roi] = sprite_alpha
+            alpha[roi] |= sprite_alpha
+
+        # objects and sprites completely covered by sprites are not objects anymore
+        visible = paste_masks.reshape(len(placed), -1).any(axis=1)
+        occluded_masks = occlude_masks(params["masks"], alpha)
+        visible_objects = occluded_masks.reshape(len(occluded_masks), -1).any(axis=1)
+
+        return {
+            "sprites": placed,
+            "paste_masks": paste_masks[visible],
+            "paste_labels": [label for (*_, label), v in zip(placed, visible) if v],
+            "occluded_masks": occluded_masks[visible_objects] if len(placed) > 0 else None,
+            # new indices of masks of the objects, -1 for removed ones
+            "object_indices": np.where(visible_objects, np.cumsum(visible_objects) - 1, -1),
+        }
+
+    def apply(self, img, sprites=(), **params):
+        if len(sprites) > 0:
+            img = img.copy()
+        for sprite, y, x, _ in sprites:
+            h, w = sprite.shape[:2]
+            # feathering reaches the kernel radius around the sprite
+            radius = int(4 * self.sigma + 0.5) if self.blend and self.sigma > 0 else 0
+            y0, x0 = max(y - radius, 0), max(x - radius, 0)
+            y1, x1 = min(y + h + radius, img.shape[0]), min(x + w + radius, img.shape[1])
+
+            roi = img[y0:y1, x0:x1]
+            paste_roi = roi.copy()
+            paste_roi[y - y0:y - y0 + h, x - x0:x - x0 + w] = sprite[..., :3]
+            alpha_roi = np.zeros(roi.shape[:2], dtype=bool)
+            alpha_roi[y - y0:y - y0 + h, x - x0:x - x0 + w] = sprite[..., 3] != 0
+
+            img[y0:y1, x0:x1] = image_copy_paste(roi, paste_roi, alpha_roi, blend=self.blend, sigma=self.sigma)
+        return img
+
+    def apply_to_mask(self, mask, **params):
+        raise NotImplementedError
+
+    def apply_to_masks(self, masks, paste_masks=None, occluded_masks=None, **params):
+        if occluded_masks is None:
+            return masks
+        return np.concatenate([occluded_masks, paste_masks])
+
+    def apply_to_bboxes(
+        self, bboxes, paste_masks=None, paste_labels=(), occluded_masks=None, object_indices=None, **params
+    ):
+        if occluded_masks is None:
+            return bboxes
+
+        # boxes of the existing objects shrink where they are covered by sprites
+        mask_indices = object_indices[np.array([int(box[5]) for box in bboxes], dtype=np.int64)]
+        bboxes = [box for box, i in zip(bboxes, mask_indices) if i >= 0]
+        mask_indices = mask_indices[mask_indices >= 0]
+        adjusted_bboxes = [
+            bbox + (tail[4], i) + tuple(tail[6:])
+            for bbox, tail, i in zip(extract_bboxes(occluded_masks[mask_indices]), bboxes, mask_indices.tolist())
+        ]
+
+        n_masks = len(occluded_masks)
+        paste_bboxes = [
+            bbox + (1, n_masks + j) + (label,) * self.n_labels
+            for j, (bbox, label) in enumerate(zip(extract_bboxes(paste_masks), paste_labels))
+        ]
+        return adjusted_bboxes + paste_bboxes
+
+    def apply_to_keypoints(self, keypoints, **params):
+        raise NotImplementedError
+
+    def get_transform_init_args_names(self):
+        return (
+            "n_objects",
+            "placement",
+            "blend",
+            "sigma",
+            "n_labels",
+        )
+
+
+@call_parse
+def build_dataset_sprite_bank(
+    src_path: Param("input directory containing JPEGImages, SegmentationClass and SegmentationObject", Path),
+    dst_path: Param("output directory for the sprite bank", Path),
+    n_samples: Param("number of samples to cut sprites from, all by default", int) = -1,
+    max_workers: Param("number of processes cutting sprites, number of CPUs by default", int) = None,
+):
+    """Cuts all annotated instances of the dataset into a sprite bank for `SpriteCopyPaste`"""
+    n = build_sprite_bank(src_path, dst_path, n_samples=n_samples, max_workers=max_workers)
+    print(f"Stored {n} sprites in: {Path(dst_path).resolve()}")
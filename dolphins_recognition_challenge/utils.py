@@ -2,7 +2,7 @@
 
 __all__ = ['SmoothedValue', 'all_gather', 'reduce_dict', 'MetricLogger', 'collate_fn', 'warmup_lr_scheduler', 'mkdir',
            'setup_for_distributed', 'is_dist_avail_and_initialized', 'get_world_size', 'get_rank', 'is_main_process',
-           'save_on_master', 'init_distributed_mode']
+           'save_on_master', 'init_distributed_mode', 'set_epoch', 'DevicePrefetcher', 'ThreadedDataLoader']
 
 # Cell
 
@@ -12,14 +12,19 @@ from typing import List, Tuple, Union, Optional, Dict, Set
 # Internal Cell
 
 from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import pickle
+import queue
+import threading
 import time
 
 import torch
+import torch.utils.data
 import torch.distributed as dist
 
 import errno
+import itertools
 import os
 
 # Cell
@@ -98,14 +103,17 @@ def all_gather(data):
     if world_size == 1:
         return [data]
 
+    # nccl gathers only cuda tensors, other backends (e.g. gloo) only cpu tensors
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+
     # serialized to a Tensor
     buffer = pickle.dumps(data)
     storage = torch.ByteStorage.from_buffer(buffer)
-    tensor = torch.ByteTensor(storage).to("cuda")
+    tensor = torch.ByteTensor(storage).to(device)
 
     # obtain Tensor size of each rank
-    local_size = torch.tensor([tensor.numel()], device="cuda")
-    size_list = [torch.tensor([0], device="cuda") for _ in range(world_size)]
+    local_size = torch.tensor([tensor.numel()], device=device)
+    size_list = [torch.tensor([0], device=device) for _ in range(world_size)]
     dist.all_gather(size_list, local_size)
     size_list = [int(size.item()) for size in size_list]
     max_size = max(size_list)
@@ -115,9 +123,9 @@ def all_gather(data):
     # gathering tensors of different shapes
     tensor_list = []
     for _ in size_list:
-        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device="cuda"))
+        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device=device))
     if local_size != max_size:
-        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device="cuda")
+        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device=device)
         tensor = torch.cat((tensor, padding), dim=0)
     dist.all_gather(tensor_list, tensor)
 
@@ -336,3 +344,158 @@ def init_distributed_mode(args):
                                          world_size=args.world_size, rank=args.rank)
     torch.distributed.barrier()
     setup_for_distributed(args.rank == 0)
+
+# Cell
+
+def set_epoch(data_loader, epoch):
+    """Sets the epoch of samplers and datasets of the data loader which shuffle by epoch, e.g. `DistributedSampler`"""
+    batch_sampler = getattr(data_loader, "batch_sampler", None)
+    for obj in [getattr(data_loader, "sampler", None), getattr(batch_sampler, "sampler", None), data_loader.dataset]:
+        if hasattr(obj, "set_epoch"):
+            obj.set_epoch(epoch)
+
+# Cell
+
+def _pin_batch(batch):
+    images, targets = batch
+    images = [image.pin_memory() for image in images]
+    targets = [{k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in t.items()} for t in targets]
+    return images, targets
+
+
+def _batch_to_device(batch, device, non_blocking=False):
+    images, targets = batch
+    images = [image.to(device, non_blocking=non_blocking) for image in images]
+    targets = [{k: v.to(device, non_blocking=non_blocking) for k, v in t.items()} for t in targets]
+    return images, targets
+
+
+class DevicePrefetcher(object):
+    """Wraps a data loader yielding (images, targets) batches and moves the next batches to the device
+    in a background thread while the current batch is being processed.
+
+    On CUDA, batches are pinned and copied asynchronously on a separate stream. Total time spent waiting
+    for batches is accumulated in `wait_time`.
+    """
+
+    _end = object()
+
+    def __init__(self, data_loader, device, depth=2):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _put(self, q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _produce(self, q, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.data_loader:
+                if stop.is_set():
+                    return
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = _batch_to_device(_pin_batch(batch), self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = _batch_to_device(batch, self.device)
+                self._put(q, (batch, event), stop)
+            self._put(q, self._end, stop)
+        except Exception as e:
+            self._put(q, e, stop)
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                item = q.get()
+                self.wait_time += time.time() - start
+                if item is self._end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    # make the compute stream wait for the copies and keep the memory alive until it is used
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    images, targets = batch
+                    for x in images + [v for t in targets for v in t.values()]:
+                        if isinstance(x, torch.Tensor):
+                            x.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+# Cell
+
+class ThreadedDataLoader(object):
+    """Loads batches of a dataset with a pool of threads in the current process, a low memory alternative
+    to DataLoader worker processes.
+
+    Decoding in cv2 and PIL releases the GIL, so threads load samples concurrently without duplicating
+    the dataset, importing libraries again or pickling samples. At most `prefetch_batches` batches are
+    loaded ahead of the consumer. Accepts the same `batch_size`, `shuffle`, `sampler` and `batch_sampler`
+    arguments as DataLoader.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None, num_workers=4,
+                 collate_fn=collate_fn, drop_last=False, prefetch_batches=None):
+        if batch_sampler is None:
+            if sampler is None:
+                if shuffle:
+                    sampler = torch.utils.data.RandomSampler(dataset)
+                else:
+                    sampler = torch.utils.data.SequentialSampler(dataset)
+            batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last)
+        self.dataset = dataset
+        self.sampler = sampler
+        self.batch_sampler = batch_sampler
+        self.num_workers = num_workers
+        self.collate_fn = collate_fn
+        self.prefetch_batches = prefetch_batches if prefetch_batches is not None else 2 * max(num_workers, 1)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def _load(self, indices):
+        return self.collate_fn([self.dataset[idx] for idx in indices])
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for indices in self.batch_sampler:
+                yield self._load(indices)
+            return
+
+        batches = iter(self.batch_sampler)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            try:
+                for indices in itertools.islice(batches, self.prefetch_batches):
+                    pending.append(executor.submit(self._load, indices))
+                while pending:
+                    batch = pending.popleft().result()
+                    for indices in itertools.islice(batches, 1):
+                        pending.append(executor.submit(self._load, indices))
+                    yield batch
+            finally:
+                # do not load batches nobody will consume
+                for future in pending:
+                    future.cancel()
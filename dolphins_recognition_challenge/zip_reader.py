@@ -0,0 +1,135 @@
+"""Read dataset files directly from a zip archive, without extracting it."""
+
+import calendar
+import fnmatch
+import os
+from io import BytesIO
+from pathlib import Path, PurePosixPath
+from types import SimpleNamespace
+from typing import *
+from zipfile import ZipFile, ZipInfo
+
+# central directory of each archive, keyed by (path, mtime, size) of the archive
+_zip_indices: Dict[Tuple[str, int, int], Dict[str, ZipInfo]] = {}
+
+# open archives of the current process, keyed by (pid, path)
+_zip_files: Dict[Tuple[int, str], ZipFile] = {}
+
+
+def _zip_index(zip_path: Path) -> Dict[str, ZipInfo]:
+    """Returns members of the archive by name, the central directory is read only once per archive version"""
+    st = os.stat(zip_path)
+    key = (str(zip_path), st.st_mtime_ns, st.st_size)
+    if key not in _zip_indices:
+        _zip_indices[key] = {info.filename: info for info in _zip_file(zip_path).infolist() if not info.is_dir()}
+    return _zip_indices[key]
+
+
+def _zip_file(zip_path: Path) -> ZipFile:
+    """Returns an open archive. Handles are never shared between processes, so every DataLoader worker opens its own."""
+    key = (os.getpid(), str(zip_path))
+    if key not in _zip_files:
+        _zip_files[key] = ZipFile(zip_path, "r")
+    return _zip_files[key]
+
+
+class ZipMember(object):
+    """ A file inside a zip archive. Supports the subset of `Path` used by the dataset.
+    """
+    def __init__(self, zip_path: Path, info: ZipInfo):
+        self.zip_path = zip_path
+        self.info = info
+
+    @property
+    def name(self) -> str:
+        return PurePosixPath(self.info.filename).name
+
+    @property
+    def stem(self) -> str:
+        return PurePosixPath(self.info.filename).stem
+
+    @property
+    def suffix(self) -> str:
+        return PurePosixPath(self.info.filename).suffix
+
+    def read_bytes(self) -> bytes:
+        with _zip_file(self.zip_path).open(self.info) as f:
+            return f.read()
+
+    def open(self, mode: str = "rb") -> BytesIO:
+        assert mode == "rb", f"zip members can only be opened for reading in binary mode, not '{mode}'"
+        return BytesIO(self.read_bytes())
+
+    def stat(self) -> SimpleNamespace:
+        """Modification time and size of the member, as stored in the archive"""
+        mtime = calendar.timegm(self.info.date_time + (0, 0, -1))
+        return SimpleNamespace(st_mtime_ns=mtime * 10 ** 9, st_size=self.info.file_size)
+
+    def resolve(self) -> "ZipMember":
+        return self
+
+    def exists(self) -> bool:
+        return True
+
+    def __lt__(self, other: "ZipMember") -> bool:
+        return self.info.filename < other.info.filename
+
+    def __str__(self):
+        return f"{self.zip_path}::{self.info.filename}"
+
+    def __repr__(self):
+        return f"ZipMember('{self}')"
+
+
+class ZipRoot(object):
+    """ A directory inside a zip archive. Supports the subset of `Path` used by the dataset.
+    """
+    def __init__(self, zip_path: Path, prefix: str = ""):
+        self.zip_path = Path(zip_path).resolve()
+        self.prefix = prefix
+
+    def __truediv__(self, name: str) -> Union["ZipRoot", ZipMember]:
+        filename = f"{self.prefix}{name}"
+        info = _zip_index(self.zip_path).get(filename)
+        if info is not None:
+            return ZipMember(self.zip_path, info)
+        return ZipRoot(self.zip_path, f"{filename}/")
+
+    @property
+    def name(self) -> str:
+        return PurePosixPath(self.prefix).name
+
+    def glob(self, pattern: str) -> Iterator[ZipMember]:
+        """Yields members directly inside the directory matching the pattern"""
+        for filename, info in _zip_index(self.zip_path).items():
+            if filename.startswith(self.prefix):
+                name = filename[len(self.prefix):]
+                if "/" not in name and fnmatch.fnmatch(name, pattern):
+                    yield ZipMember(self.zip_path, info)
+
+    def rglob(self, pattern: str) -> Iterator[ZipMember]:
+        """Yields members anywhere below the directory with names matching the pattern"""
+        for filename, info in _zip_index(self.zip_path).items():
+            if filename.startswith(self.prefix) and fnmatch.fnmatch(PurePosixPath(filename).name, pattern):
+                yield ZipMember(self.zip_path, info)
+
+    def exists(self) -> bool:
+        return any(filename.startswith(self.prefix) for filename in _zip_index(self.zip_path))
+
+    def is_dir(self) -> bool:
+        return self.exists()
+
+    def stat(self) -> os.stat_result:
+        """Directories inside the archive change only together with the archive, so this is the stat of the archive"""
+        return os.stat(self.zip_path)
+
+    def sidecar_path(self, name: str) -> Path:
+        """Path of a metadata file for this directory, stored next to the archive"""
+        directory = self.prefix.strip("/").replace("/", "-")
+        return self.zip_path.parent / f".{self.zip_path.stem}-{directory}{name}"
+
+    def __str__(self):
+        return f"{self.zip_path}::{self.prefix}"
+
+    def __repr__(self):
+        return f"ZipRoot('{self}')"